@@ -7,9 +7,16 @@ from . import account
 def register():
     Pool.register(
         account.AccountImportContaplusStart,
+        account.AccountImportContaplusValidation,
         account.ImportRecord,
+        account.ImportRecordPhase,
+        account.ContaplusMapping,
         account.Move,
         account.Invoice,
+        account.Account,
+        account.Journal,
+        account.Tax,
+        account.Cron,
         module='account_import_contaplus', type_='model')
     Pool.register(
         account.AccountImportContaplus,
@@ -1,19 +1,127 @@
+import cProfile
+import datetime
+import hashlib
+import io
 import logging
+import os
+import tempfile
+import time
+from bisect import bisect_right
+from collections import defaultdict
+from contextlib import contextmanager
 from retrofix.exception import RetrofixException
 from retrofix.fields import Char, Date, Field, Integer
-from retrofix.record import Record
 from decimal import Decimal, InvalidOperation
 
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.filestore import filestore, FileStore
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
-from trytond.model import ModelView, ModelSQL, fields
+from trytond.model import ModelView, ModelSQL, Index, Unique, fields
+from trytond.pyson import Eval
 from trytond.pool import Pool, PoolMeta
 from trytond.wizard import Wizard, StateTransition, StateView, Button
-from trytond.transaction import Transaction
-from functools import reduce
+from trytond.modules.account.exceptions import PeriodNotFoundError
+from trytond.transaction import Transaction, TransactionError
+from trytond.tools import grouped_slice
+
+from .exceptions import (
+    ContaplusError, InvalidLineError, DuplicateError, AccountError,
+    PartyError, PaymentTermError, UnbalanceError, TotalError)
 
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = config.getint('account_import_contaplus', 'batch_size',
+    default=1000)
+PROFILE = config.getboolean('account_import_contaplus', 'profile',
+    default=False)
+BULK_CREATE = config.getboolean('account_import_contaplus', 'bulk_create',
+    default=False)
+
+PHASES = [
+    ('validate', 'Validate'),
+    ('parse', 'Parse'),
+    ('resolve', 'Resolve'),
+    ('build', 'Build'),
+    ('save', 'Save'),
+    ('update_taxes', 'Update Taxes'),
+    ('check_totals', 'Check Totals'),
+    ('post', 'Post'),
+    ]
+
+# the problems of a file are reported grouped by these types
+PROBLEM_TYPES = [
+    ('parse', 'Invalid Lines'),
+    ('duplicate', 'Existing Documents'),
+    ('account', 'Accounts'),
+    ('party', 'Parties'),
+    ('payment_term', 'Payment Terms'),
+    ('period', 'Periods'),
+    ('unbalance', 'Unbalanced Moves'),
+    ('total', 'Invoice Totals'),
+    ('other', 'Other'),
+    ]
+
+
+class ImportStats(object):
+    '''
+    Wall time, counts and ORM calls of the phases of an import.
+
+    The time of a phase does not include the time of the phases nested in
+    it. ORM calls are the searches, reads, saves and posts issued by the
+    importer, each of them may run many SQL queries.
+    '''
+
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.calls = defaultdict(int)
+        self._names = []
+        self._nested = []
+
+    def _add(self, name, elapsed, count):
+        self.durations[name] += elapsed - self._nested.pop()
+        self.counts[name] += count
+        if self._nested:
+            self._nested[-1] += elapsed
+
+    @contextmanager
+    def phase(self, name, count=0):
+        self._names.append(name)
+        self._nested.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._names.pop()
+            self._add(name, time.perf_counter() - start, count)
+
+    def iterate(self, name, iterable):
+        'Yield the items of iterable timing each next as phase name'
+        iterator = iter(iterable)
+        while True:
+            self._names.append(name)
+            self._nested.append(0)
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._names.pop()
+                self._add(name, time.perf_counter() - start, 0)
+            self.counts[name] += 1
+            yield item
+
+    def call(self, count=1):
+        'Count ORM calls on the current phase'
+        if self._names:
+            self.calls[self._names[-1]] += count
+
+    def count(self, name, count):
+        self.counts[name] += count
+
 
 class DecimalField(Field):
     # decimals in files are separated by period '.'
@@ -26,7 +134,8 @@ class DecimalField(Field):
         try:
             return Decimal(value)
         except InvalidOperation:
-            raise UserError('%s. Invalid decimal value: %s' % (self._name, value))
+            raise InvalidLineError(
+                '%s. Invalid decimal value: %s' % (self._name, value))
 
 
 ENTRY_RECORD = (
@@ -64,18 +173,153 @@ ENTRY_RECORD = (
     (288, 10, 'numero_inv', Char))
 
 
+# fields used by the importers, converted when the line is parsed. The
+# others are only converted on first access.
+ENTRY_FIELDS = ('asien', 'fecha', 'sub_cta', 'contra', 'concepto', 'factura',
+    'documento', 'serie', 'euro_debe', 'euro_haber')
+
+
+class RecordParser(object):
+    """
+    Fixed-width parser compiled once from a retrofix record structure.
+
+    Lines are parsed into slotted objects. Only the fields in eager are
+    converted at parse time, the rest on first access.
+    """
+
+    def __init__(self, structure, eager):
+        names = []
+        self._eager = []
+        self._lazy = {}
+        self.slices = {}
+        for start, size, name, field in structure:
+            if not isinstance(field, Field):
+                field = field()
+            field._size = size
+            field._name = name
+            names.append(name)
+            self.slices[name] = slice(start - 1, start - 1 + size)
+            if type(field) is Char:
+                # a slice is never longer than the field so ljust is all
+                # Char.set_from_file does
+                convert = lambda value, size=size: value.ljust(size)
+            else:
+                convert = field.set_from_file
+            item = (name, start - 1, start - 1 + size, convert)
+            if name in eager:
+                self._eager.append(item)
+            else:
+                self._lazy[name] = item
+        self._eager = tuple(self._eager)
+        self.record_class = self._create_record_class(names)
+
+    def _create_record_class(self, names):
+        lazy = self._lazy
+
+        class ParsedRecord(object):
+            __slots__ = ('_line',) + tuple(names)
+
+            def __getattr__(self, name):
+                if name not in lazy:
+                    raise AttributeError(name)
+                _, start, end, convert = lazy[name]
+                try:
+                    value = convert(self._line[start:end])
+                except (AssertionError, RetrofixException):
+                    raise RetrofixException('Invalid record: %s' % self._line)
+                setattr(self, name, value)
+                return value
+
+            def __repr__(self):
+                return repr(self._line)
+
+        return ParsedRecord
+
+    def parse(self, line):
+        record = self.record_class()
+        record._line = line
+        try:
+            for name, start, end, convert in self._eager:
+                setattr(record, name, convert(line[start:end]))
+        except (AssertionError, RetrofixException):
+            raise RetrofixException('Invalid record: %s' % line)
+        return record
+
+
+ENTRY_PARSER = RecordParser(ENTRY_RECORD, ENTRY_FIELDS)
+
+# bytes looked at to detect invoice files
+INVOICE_SAMPLE_SIZE = 64 * 1024
+
+
 def read_line(line):
-    if Record.valid(line, ENTRY_RECORD):
-        return Record.extract(line, ENTRY_RECORD)
+    return ENTRY_PARSER.parse(line)
+
+
+def iter_lines(data, encoding='utf8'):
+    """
+    Yield the lines of data without their line break.
+
+    data may be a str, bytes or a file-like object. Bytes are decoded one
+    line at a time so the content is never copied as a whole.
+    """
+    if isinstance(data, str):
+        data = io.StringIO(data)
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        data = io.BytesIO(data)
+    if isinstance(data, io.TextIOBase):
+        stream = data
     else:
-        raise RetrofixException('Invalid record: %s' % line)
+        stream = io.TextIOWrapper(data, encoding=encoding, newline=None)
+    try:
+        for line in stream:
+            yield line.rstrip('\n')
+    finally:
+        if stream is not data:
+            # do not close the stream given by the caller
+            stream.detach()
 
 
 def read_all(data):
     try:
-        return map(read_line, data.splitlines())
+        for line in iter_lines(data):
+            yield read_line(line)
+    except UnicodeDecodeError as e:
+        raise InvalidLineError(str(e))
+
+
+def read_columns(data, names):
+    """
+    Yield a tuple with the raw values of names for each line with subcuenta.
+
+    Lines are only sliced, not parsed.
+    """
+    sub_cta = ENTRY_PARSER.slices['sub_cta']
+    slices = [ENTRY_PARSER.slices[name] for name in names]
+    try:
+        for line in iter_lines(data):
+            if line[sub_cta].strip():
+                yield tuple(line[s] for s in slices)
     except UnicodeDecodeError as e:
-        raise UserError(str(e))
+        raise InvalidLineError(str(e))
+
+
+def is_invoice_file(data, sample_size=INVOICE_SAMPLE_SIZE):
+    '''
+    Return if data has lines with contrapartida, which only invoices have.
+
+    Only the contra column of the lines in the first sample_size bytes is
+    looked at.
+    '''
+    if isinstance(data, str):
+        data = data[:sample_size].encode('utf8')
+    contra = ENTRY_PARSER.slices['contra']
+    lines = bytes(data[:sample_size]).splitlines()
+    if len(data) > sample_size:
+        # the last line may be cut
+        lines = lines[:-1]
+    return any(line[contra].strip() for line in lines)
+
 
 def filter_with_account(data):
     return filter((lambda s: len(s.sub_cta.strip()) != 0), data)
@@ -85,16 +329,101 @@ def read(data):
     return filter_with_account(read_all(data))
 
 
-def add_tupla2(t1, t2):
-    return (t1[0] + t2[0], t1[1] + t2[1])
+def not_balance(credit_debit):
+    credit, debit = credit_debit
+    if credit != debit:
+        logger.debug('unbalanced credit %s, debit %s', credit, debit)
+        return True
+    return False
+
+
+def get_move_line_amounts(iline, total_debit, total_credit):
+    '''
+    Return the debit and the credit of the move line of iline.
+
+    total_debit and total_credit are the sums of the previous lines of the
+    file.
+    '''
+    # swap debe haber in some cases due to error.
+    # in caja the concepto/clave determines if it is debe or haber.
+    if iline.concepto.strip() in (
+            '', 'TALON RTTE', 'CLAVE MANUAL', 'PAGO ITV', 'DESEMBOLSO',
+            'TRASP. A BAN', 'TRASP. A BANC', 'ANTICP-VALES'):
+        return iline.euro_haber + iline.euro_debe, 0
+    elif iline.concepto.strip() == 'cierre de caja':
+        if (total_credit > total_debit):
+            return iline.euro_haber + iline.euro_debe, 0
+        else:
+            return 0, iline.euro_haber + iline.euro_debe
+    else:
+        return iline.euro_debe, iline.euro_haber
 
 
-def not_balance(move):
-    credit_debit = reduce(
-        lambda t_cd, line: add_tupla2(t_cd, (line.credit, line.debit)),
-        move.lines, [0, 0])
-    logger.info('credit %f, debit %f' % (credit_debit[0], credit_debit[1]))
-    return credit_debit[0] != credit_debit[1]
+def get_invoice_line_price(iline):
+    'Return the unit price of the invoice line of iline'
+    if iline.concepto.strip() == 'DIFERENCIA PORTE':
+        unit_price = iline.euro_haber * -1
+    else:
+        unit_price = iline.euro_haber
+    # abonos negatius
+    if iline.serie == 'A':
+        unit_price = unit_price * -1
+    return unit_price
+
+
+def error_message(exception):
+    'Return the message to show for exception'
+    if isinstance(exception, UserError):
+        return exception.message
+    return str(exception)
+
+
+def problem_type(exception):
+    'Return the type of the problem reported by exception'
+    if isinstance(exception, ContaplusError):
+        return exception.problem_type
+    elif isinstance(exception, PeriodNotFoundError):
+        return 'period'
+    elif isinstance(exception, (RetrofixException, UnicodeDecodeError)):
+        return 'parse'
+    return 'other'
+
+
+def problem(line, document, message, type_='other'):
+    'Return a problem found validating a file'
+    return {
+        'line': line,
+        'document': document,
+        'message': message,
+        'type': type_,
+        }
+
+
+def exception_problem(line, document, exception):
+    'Return the problem found validating a file reported by exception'
+    return problem(line, document, error_message(exception),
+        problem_type(exception))
+
+
+def format_problems(problems):
+    'Return problems as text grouped by type'
+    if not problems:
+        return gettext('account_import_contaplus.msg_validation_no_problems')
+    groups = defaultdict(list)
+    for p in problems:
+        groups[p['type']].append(p)
+    text = []
+    for type_, label in PROBLEM_TYPES:
+        if type_ not in groups:
+            continue
+        text.append(gettext('account_import_contaplus.msg_validation_type',
+                type=label, count=len(groups[type_])))
+        text.extend(
+            gettext('account_import_contaplus.msg_validation_problem',
+                line=p['line'] or '-', document=p['document'] or '-',
+                message=p['message'])
+            for p in groups[type_])
+    return '\n'.join(text)
 
 
 def complete_account(account, num_digits, fill_with):
@@ -112,18 +441,44 @@ def convert_account(account):
     else:
         return account
 
-def find_invoice(number, company):
-    pool = Pool()
-    Invoice = pool.get('account.invoice')
-    invoices = Invoice.search([('number', '=', number),
-                               ('company', '=', company)], limit=1)
-    return invoices[0] if invoices else None
-
-def check_invoice_not_exists(number, company):
-    if find_invoice(number, company):
-        raise UserError(
-            gettext('account_import_contaplus.msg_factura_exists',
-                    number=number))
+def collapse_account(account):
+    # customer and supplier subcuentas are booked on the main account
+    # and the subcuenta identifies the party.
+    if account[:2] in ('40', '41', '43'):
+        return account[:2] + ('0' * 6)
+    return account
+
+
+def check_moves_not_exist(numbers, company, stats=None):
+    Move = Pool().get('account.move')
+    existing = set()
+    for sub_numbers in grouped_slice(sorted(numbers)):
+        if stats:
+            stats.call()
+        existing.update(m.number for m in Move.search([
+                    ('number', 'in', list(sub_numbers)),
+                    ('company', '=', company),
+                    ]))
+    if existing:
+        raise DuplicateError(
+            gettext('account_import_contaplus.msg_numbers_exist',
+                    move_numbers=', '.join(sorted(existing))))
+
+
+def check_invoices_not_exist(numbers, company, stats=None):
+    Invoice = Pool().get('account.invoice')
+    existing = set()
+    for sub_numbers in grouped_slice(sorted(numbers)):
+        if stats:
+            stats.call()
+        existing.update(i.number for i in Invoice.search([
+                    ('number', 'in', list(sub_numbers)),
+                    ('company', '=', company),
+                    ]))
+    if existing:
+        raise DuplicateError(
+            gettext('account_import_contaplus.msg_facturas_exist',
+                    numbers=', '.join(sorted(existing))))
 
 
 class Move(metaclass=PoolMeta):
@@ -158,207 +513,995 @@ class Invoice(metaclass=PoolMeta):
         return super(Invoice, cls)._get_origin() + ['import.record']
 
 
+class ResolveCacheMixin:
+    'Clear the resolution cache of the importer when records are modified'
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Pool().get('import.record')._resolve_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('import.record')._resolve_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        Pool().get('import.record')._resolve_cache.clear()
+
+
+class Account(ResolveCacheMixin, metaclass=PoolMeta):
+    __name__ = 'account.account'
+
+
+class Journal(ResolveCacheMixin, metaclass=PoolMeta):
+    __name__ = 'account.journal'
+
+
+class Tax(ResolveCacheMixin, metaclass=PoolMeta):
+    __name__ = 'account.tax'
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('import.record|post_imported',
+                "Post Imported Contaplus Documents"))
+        cls.method.selection.append(
+            ('import.record|delete_drafts',
+                "Delete Draft Contaplus Imports"))
+
+
 class ImportRecord(ModelSQL, ModelView):
     'Import Record'
     __name__ = 'import.record'
     _rec_name = 'filename'
     # filename
     filename = fields.Char('File Name')
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    journal = fields.Many2One('account.journal', 'Journal', readonly=True)
+    is_invoice = fields.Boolean('Invoice?', readonly=True)
+    batch_size = fields.Integer('Batch Size', readonly=True)
+    commit_batches = fields.Boolean('Commit Batches', readonly=True)
+    bulk_create = fields.Boolean('Bulk Create', readonly=True)
+    post_later = fields.Boolean('Post Later', readonly=True)
+    collect_errors = fields.Boolean('Collect Errors', readonly=True)
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('posting', 'Posting'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', readonly=True)
+    lines_processed = fields.Integer('Lines Processed', readonly=True)
+    documents_processed = fields.Integer('Documents Processed', readonly=True)
+    documents_posted = fields.Integer('Documents Posted', readonly=True)
+    error_message = fields.Text('Error Message', readonly=True)
+    phases = fields.One2Many('import.record.phase', 'record', 'Phases',
+        readonly=True)
+    file_hash = fields.Char('File Hash', readonly=True)
+    checkpoint = fields.Char('Checkpoint', readonly=True,
+        help="The last document committed.")
+    # ids of the accounts, journals and taxes resolved by previous imports
+    _resolve_cache = Cache('import.record.resolve', context=False)
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.company, Index.Equality()),
+                (t.file_hash, Index.Equality())))
+        cls._buttons.update({
+                'resume': {
+                    'invisible': Eval('state') != 'failed',
+                    'depends': ['state'],
+                    },
+                'create_mappings': {
+                    'invisible': Eval('state') != 'done',
+                    'depends': ['state'],
+                    },
+                })
 
-class AccountImportContaplusStart(ModelView):
-    'Account Import Contaplus Start'
-    __name__ = 'account.import.contaplus.start'
-    name = fields.Char('Name', states={'readonly': True}, required=True)
-    data = fields.Binary(
-        'File', filename='name', required=True, depends=['name'])
-    is_invoice = fields.Boolean('Invoice?')
-    journal = fields.Many2One('account.journal', 'Journal', required=True)
+    @staticmethod
+    def default_state():
+        return 'queued'
 
-    @fields.depends('is_invoice')
-    def on_change_is_invoice(self):
-        journal_type = 'revenue' if self.is_invoice else 'general'
-        Journal = Pool().get('account.journal')
-        self.journal = Journal.search(
-            [('type', "=", journal_type)], limit=1)[0].id
+    @staticmethod
+    def default_bulk_create():
+        return BULK_CREATE
 
-    @fields.depends('data')
-    def on_change_data(self):
-        is_invoice = False
+    @staticmethod
+    def default_post_later():
+        return False
 
-        if self.data:
-            data = None
+    @staticmethod
+    def default_collect_errors():
+        return False
+
+    @staticmethod
+    def default_lines_processed():
+        return 0
+
+    @staticmethod
+    def default_documents_processed():
+        return 0
+
+    @staticmethod
+    def default_documents_posted():
+        return 0
+
+    @staticmethod
+    def hash_data(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def hash_file(file):
+        'Return the hash of the content of the binary file object'
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def check_not_imported(cls, company, file_hash):
+        'Raise if the file with file_hash was already imported for company'
+        records = cls.search([
+                ('company', '=', company),
+                ('file_hash', '=', file_hash),
+                ('state', 'not in', ['draft', 'failed']),
+                ], limit=1)
+        if records:
+            record, = records
+            raise UserError(
+                gettext('account_import_contaplus.msg_file_already_imported',
+                    record=record.rec_name))
+
+    def get_attachment(self):
+        '''
+        Return the attachment with the imported file.
+
+        It may belong to a previous import of the same file, but not to a
+        draft as they are deleted with their attachment.
+        '''
+        Attachment = Pool().get('ir.attachment')
+        records = [self]
+        if self.file_hash:
+            records += self.search([
+                    ('company', '=', self.company),
+                    ('file_hash', '=', self.file_hash),
+                    ('id', '!=', self.id),
+                    ('state', '!=', 'draft'),
+                    ], order=[('id', 'ASC')])
+        for record in records:
+            attachments = Attachment.search([
+                    ('resource', '=', str(record)),
+                    ], order=[('id', 'ASC')], limit=1)
+            if attachments:
+                return attachments[0]
+
+    def get_data(self):
+        'Return the content of the imported file'
+        return self.get_attachment().data
+
+    def open_data(self):
+        '''
+        Return a binary file object with the content of the imported file.
+
+        The file is read from the filestore as it is parsed when it is stored
+        locally, otherwise its content is loaded.
+        The filestore does not provide a way to open a file, so its path is
+        computed with the private FileStore._filename and only the default
+        FileStore is supported. Other filestores, like the ones configured
+        with the class option, load the whole file in memory.
+        '''
+        Attachment = Pool().get('ir.attachment')
+        attachment = self.get_attachment()
+        if attachment.file_id and type(filestore) is FileStore:
+            prefix = Attachment.data.store_prefix
+            if prefix is None:
+                prefix = Transaction().database.name
+            path = filestore._filename(attachment.file_id, prefix)
+            if os.path.isfile(path):
+                return open(path, 'rb')
+        return io.BytesIO(attachment.data)
+
+    def set_data(self, data):
+        '''
+        Attach data as the imported file.
+
+        The data is not stored again if a previous import of the company has
+        the same file.
+        '''
+        Attachment = Pool().get('ir.attachment')
+        if not self.file_hash:
+            self.file_hash = self.hash_data(data)
+            self.save()
+        if self.get_attachment():
+            return
+        attachment = Attachment()
+        attachment.name = self.filename
+        attachment.resource = self
+        attachment.data = data
+        attachment.save()
+
+    @classmethod
+    def delete_drafts(cls, records=None):
+        '''
+        Delete the draft records and their attachment.
+
+        Drafts are created by the wizard to store the uploaded file, so they
+        are left when it is cancelled. Without records, the drafts of more
+        than a day are deleted; it is run by the scheduler. The drafts with
+        committed documents are kept to resume their import.
+        '''
+        Attachment = Pool().get('ir.attachment')
+        if records is None:
+            records = cls.search([
+                    ('state', '=', 'draft'),
+                    ('create_date', '<',
+                        datetime.datetime.now() - datetime.timedelta(days=1)),
+                    ])
+        records = [r for r in records
+            if r.state == 'draft' and not r.checkpoint]
+        for sub_records in grouped_slice(records):
+            Attachment.delete(Attachment.search([
+                        ('resource', 'in', [str(r) for r in sub_records]),
+                        ]))
+        cls.delete(records)
+
+    @classmethod
+    @ModelView.button
+    def resume(cls, records):
+        'Import again the failed records from their checkpoint'
+        cls.write(records, {'state': 'queued'})
+        cls.__queue__.run_import(records)
+
+    @classmethod
+    @ModelView.button
+    def create_mappings(cls, records):
+        '''
+        Create the Contaplus mappings of the subcuentas of the records.
+
+        The subcuentas not mapped yet are resolved as they were imported.
+        '''
+        Mapping = Pool().get('contaplus.mapping')
+        to_create = []
+        for record in records:
+            company = record.company
+            mappings = Mapping.get_mappings(company)
+            with record.open_data() as data:
+                subcuentas = {sub_cta.strip()
+                    for sub_cta, in read_columns(data, ('sub_cta',))}
+            subcuentas.difference_update(mappings)
+            subcuentas.difference_update(
+                v['subcuenta'] for v in to_create
+                if v['company'] == company.id)
+            codes = set(map(convert_account, subcuentas))
+            accounts = record.get_accounts(
+                codes | set(map(collapse_account, codes)), company)
+            parties = record.get_parties(
+                company.party.code + '-' + code for code in codes)
+            for subcuenta in sorted(subcuentas):
+                try:
+                    account, party = record.get_subcuenta_account(
+                        subcuenta, accounts, parties)
+                except UserError:
+                    continue
+                to_create.append({
+                        'company': company.id,
+                        'subcuenta': subcuenta,
+                        'account': account.id,
+                        'party': party.id if party else None,
+                        })
+        Mapping.create(to_create)
+
+    def get_committed(self, stats=None):
+        'Return the numbers of the documents committed by previous runs'
+        pool = Pool()
+        if not self.checkpoint:
+            return set()
+        if self.is_invoice:
+            Model = pool.get('account.invoice')
+        else:
+            Model = pool.get('account.move')
+        if stats:
+            stats.call()
+        return {d.number for d in Model.search([
+                    ('origin', '=', str(self)),
+                    ])}
+
+    @classmethod
+    def run_import(cls, records):
+        'Import records from the queue, errors are stored on the record'
+        for record in records:
             try:
-                data = str(self.data, 'utf8')
-            except UnicodeDecodeError:
+                record.process()
+            except TransactionError:
+                raise
+            except Exception:
+                # the error is stored on the record
                 pass
-            if data:
-                for iline in read_all(data):
-                    if len(iline.contra.strip()) > 0:
-                        is_invoice = True
-                        break
 
-        self.is_invoice = is_invoice
-        self.on_change_is_invoice()
+    def process(self):
+        '''
+        Import the file and commit it.
+
+        The state is committed before importing so the progress can be
+        followed. On error, the record is committed as failed with the error
+        message and the error is raised again. On transaction error, the
+        previous state is committed so the caller can retry with the locks
+        required.
+        '''
+        transaction = Transaction()
+        state = self.state
+        self.state = 'running'
+        self.save()
+        transaction.commit()
+        try:
+            self.import_file()
+        except TransactionError:
+            transaction.rollback()
+            record = self.__class__(self.id)
+            record.state = state
+            record.save()
+            transaction.commit()
+            raise
+        except Exception as e:
+            logger.exception('Import of "%s" failed', self.rec_name)
+            transaction.rollback()
+            record = self.__class__(self.id)
+            record.state = 'failed'
+            record.error_message = error_message(e)
+            record.save()
+            transaction.commit()
+            raise
+        transaction.commit()
+
+    def import_file(self):
+        'Import the moves or the invoices of the attached file'
+        self.state = 'running'
+        self.lines_processed = 0
+        self.documents_processed = 0
+        self.error_message = None
+        stats = ImportStats()
+        profile = cProfile.Profile() if PROFILE else None
+        if profile:
+            profile.enable()
+        try:
+            with Transaction().set_context(company=self.company.id):
+                if self.collect_errors:
+                    self.check_problems(stats)
+                if self.is_invoice:
+                    with Transaction().set_context(_skip_warnings=True):
+                        self.import_invoices(stats)
+                else:
+                    self.import_moves(stats)
+        finally:
+            if profile:
+                profile.disable()
+        self.state = 'posting' if self.post_later else 'done'
+        self.save()
+        self.save_stats(stats)
+        self.log_stats(stats)
+        if profile:
+            self.attach_profile(profile)
+
+    def check_problems(self, stats):
+        'Raise one error with all the problems found validating the file'
+        with stats.phase('validate'):
+            problems = self.validate_file()
+        if problems:
+            raise UserError(
+                gettext('account_import_contaplus.msg_import_problems',
+                    count=len(problems), problems=format_problems(problems)))
+
+    @classmethod
+    def post_imported(cls):
+        '''
+        Post the documents of the records imported to post later.
+
+        It is run by the scheduler. Each record is posted in batches which
+        are committed so the progress can be followed, and errors are stored
+        on the record which can be resumed.
+        '''
+        transaction = Transaction()
+        for record in cls.search([
+                    ('state', '=', 'posting'),
+                    ], order=[('id', 'ASC')]):
+            try:
+                with transaction.set_context(company=record.company.id,
+                        _skip_warnings=True):
+                    record.post_documents()
+            except TransactionError:
+                # the scheduler retries with the locks required
+                raise
+            except Exception as e:
+                logger.exception('Posting of "%s" failed', record.rec_name)
+                transaction.rollback()
+                record = cls(record.id)
+                record.state = 'failed'
+                record.error_message = error_message(e)
+                record.save()
+            transaction.commit()
+
+    def post_documents(self):
+        'Post the draft documents of the record in order by batch'
+        pool = Pool()
+        transaction = Transaction()
+        if self.is_invoice:
+            Model = pool.get('account.invoice')
+            order = [('invoice_date', 'ASC'), ('id', 'ASC')]
+        else:
+            Model = pool.get('account.move')
+            order = [('date', 'ASC'), ('id', 'ASC')]
+        documents = Model.search([
+                ('origin', '=', str(self)),
+                ('state', '=', 'draft'),
+                ], order=order)
+        for sub_documents in grouped_slice(
+                documents, self.batch_size or BATCH_SIZE):
+            sub_documents = Model.browse(sub_documents)
+            Model.post(sub_documents)
+            self.documents_posted += len(sub_documents)
+            self.save()
+            transaction.commit()
+        self.state = 'done'
+        self.save()
+
+    def save_stats(self, stats):
+        'Store the statistics of the running import as phases'
+        Phase = Pool().get('import.record.phase')
+        Phase.delete(Phase.search([
+                    ('record', '=', self.id),
+                    ]))
+        Phase.create([{
+                    'record': self.id,
+                    'phase': name,
+                    'duration': round(stats.durations[name], 3),
+                    'count': stats.counts[name],
+                    'calls': stats.calls[name],
+                    } for name, _ in PHASES
+                if name in stats.durations])
+
+    def log_stats(self, stats):
+        'Log a summary of each phase of the running import'
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        for name, _ in PHASES:
+            if name in stats.durations:
+                logger.info('%s %s: %.3fs, %d items, %d ORM calls',
+                    self.rec_name, name, stats.durations[name],
+                    stats.counts[name], stats.calls[name])
+
+    def attach_profile(self, profile):
+        'Attach the cProfile statistics of profile to the record'
+        Attachment = Pool().get('ir.attachment')
+        fd, path = tempfile.mkstemp(suffix='.prof')
+        try:
+            os.close(fd)
+            profile.dump_stats(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            os.remove(path)
+        attachment = Attachment()
+        attachment.name = '%s.prof' % self.filename
+        attachment.resource = self
+        attachment.data = data
+        attachment.save()
+
+    def validate_file(self):
+        '''
+        Return the problems found importing the file without saving anything.
+
+        Each problem is a dictionary with the line number in the file, the
+        document number and the message.
+        '''
+        problems = []
+        with Transaction().set_context(company=self.company.id):
+            if self.is_invoice:
+                self.validate_invoices(problems)
+            else:
+                self.validate_moves(problems)
+        return problems
 
     @staticmethod
-    def default_journal():
-        Journal = Pool().get('account.journal')
-        return Journal.search([('type', '=', 'general')], limit=1)[0].id
+    def _iter_validate(data, problems):
+        'Yield the line number and the parsed lines of data with subcuenta'
+        for number, line in enumerate(iter_lines(data), 1):
+            try:
+                iline = read_line(line)
+            except (RetrofixException, UserError) as e:
+                problems.append(exception_problem(number, None, e))
+                continue
+            if iline.sub_cta.strip():
+                yield number, iline
 
+    def validate_moves(self, problems):
+        'Append to problems the ones found importing the moves of the file'
+        company = self.company
 
-class AccountImportContaplus(Wizard):
-    'Account Import Contaplus'
-    __name__ = 'account.import.contaplus'
-    start = StateView(
-        "account.import.contaplus.start",
-        'account_import_contaplus.account_import_contaplus_start_view_form', [
-            Button('Cancel', 'end', 'tryton-cancel'), Button(
-                'Import', 'import_', 'tryton-ok', default=True)
-        ])
-    import_ = StateTransition()
-    def get_party(self, party):
-        logger.info(party)
+        pre = "ALE-"
+        mappings = self.get_mappings(company)
+        codes, numbers = set(), set()
+        try:
+            with self.open_data() as data:
+                for sub_cta, asien in read_columns(
+                        data, ('sub_cta', 'asien')):
+                    sub_cta = sub_cta.strip()
+                    if sub_cta not in mappings:
+                        codes.add(convert_account(sub_cta))
+                    numbers.add(pre + asien)
+        except UserError as e:
+            # the lines can not be read
+            problems.append(exception_problem(None, None, e))
+            return
+        try:
+            check_moves_not_exist(numbers - self.get_committed(), company)
+        except UserError as e:
+            problems.append(exception_problem(None, None, e))
+        accounts = self.get_accounts(
+            codes | set(map(collapse_account, codes)), company)
+        parties = self.get_parties(
+            company.party.code + '-' + code for code in codes)
+        periods = self.get_periods(company)
+
+        total_credit = 0
+        total_debit = 0
+        first_lines = {}
+        # credit and debit of each move
+        balances = defaultdict(lambda: [0, 0])
+        with self.open_data() as data:
+            for number, iline in self._iter_validate(data, problems):
+                asien = pre + iline.asien
+                try:
+                    if asien not in first_lines:
+                        first_lines[asien] = number
+                        self.get_period(iline.fecha, periods, company)
+                    self.get_move_line_account(
+                        iline, accounts, parties, mappings)
+                except UserError as e:
+                    problems.append(exception_problem(number, asien, e))
+
+                debit, credit = get_move_line_amounts(
+                    iline, total_debit, total_credit)
+                total_debit += debit
+                total_credit += credit
+                balance = balances[asien]
+                balance[0] += credit
+                balance[1] += debit
+
+        for asien, balance in balances.items():
+            if not_balance(balance):
+                problems.append(problem(first_lines[asien], asien,
+                        gettext('account_import_contaplus'
+                            '.msg_unbalance_lines'), 'unbalance'))
+
+    def validate_invoices(self, problems):
+        'Append to problems the ones found importing the invoices of the file'
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        company = self.company
+        currency = company.currency
+
+        vat_21, vat_0 = self.get_vats()
+
+        mappings = self.get_mappings(company)
+        codes, customers, numbers = set(), set(), set()
+        try:
+            with self.open_data() as data:
+                for sub_cta, serie, factura in read_columns(
+                        data, ('sub_cta', 'serie', 'factura')):
+                    sub_cta = sub_cta.strip()
+                    mapping = mappings.get(sub_cta)
+                    if not mapping:
+                        codes.add(sub_cta)
+                    # mappings without party use the party of the subcuenta
+                    if sub_cta[:2] == '43' and not (mapping and mapping[1]):
+                        customers.add(sub_cta)
+                    numbers.add(serie.strip() + factura.strip())
+        except UserError as e:
+            # the lines can not be read
+            problems.append(exception_problem(None, None, e))
+            return
+        try:
+            check_invoices_not_exist(numbers - self.get_committed(), company)
+        except UserError as e:
+            problems.append(exception_problem(None, None, e))
+        accounts = self.get_accounts(codes, company)
+        parties = self.get_parties(company.party.code + '-' + code
+            for code in customers)
+
+        # first line, date, total, vat and lines of each invoice
+        invoices = {}
+        invoice = None  # current invoice
+        with self.open_data() as data:
+            for number, iline in self._iter_validate(data, problems):
+                iline.factura = iline.factura.strip()
+                iline.serie = iline.serie.strip()
+                invoice_number = iline.serie + iline.factura
+                if invoice_number not in invoices:
+                    invoice = invoices[invoice_number] = {
+                        'line': number,
+                        'date': iline.fecha,
+                        'total': None,
+                        'vat': vat_0,
+                        'lines': [],
+                        }
+
+                account = iline.sub_cta.strip()
+                try:
+                    if account[:2] == '43':
+                        self.get_invoice_party(iline, parties, mappings)
+                        invoice['total'] = iline.euro_debe + iline.euro_haber
+                        # abonos negatius
+                        if iline.serie == 'A':
+                            invoice['total'] = invoice['total'] * -1
+
+                    if account[:1] == '7' or account[:2] == '44':
+                        self.get_invoice_line_account(
+                            account, accounts, mappings)
+                        if iline.concepto.strip() == 'AVERIAS/FALTAS/R':
+                            taxes = [vat_0]
+                        else:
+                            taxes = None
+                        invoice['lines'].append(
+                            (get_invoice_line_price(iline), taxes))
+                except UserError as e:
+                    problems.append(
+                        exception_problem(number, invoice_number, e))
+
+                if account[:3] == '477':
+                    invoice['vat'] = vat_21
+
+        for invoice_number, invoice in invoices.items():
+            if not invoice['lines'] or invoice['total'] is None:
+                continue
+            untaxed_amount = tax_amount = 0
+            for unit_price, taxes in invoice['lines']:
+                untaxed_amount += currency.round(unit_price)
+                tax_amount += sum(t['amount'] for t in Tax.compute(
+                        taxes or [invoice['vat']], unit_price, 1,
+                        invoice['date']))
+            total_amount = untaxed_amount + currency.round(tax_amount)
+            if total_amount != invoice['total']:
+                problems.append(problem(invoice['line'], invoice_number,
+                        gettext('account_import_contaplus'
+                            '.msg_unmatch_total_invoice',
+                            invoice=invoice_number), 'total'))
+
+    def get_parties(self, codes, stats=None):
+        'Return a dictionary with the list of parties for each code'
         Party = Pool().get('party.party')
-        parties = Party.search([('rec_name', 'ilike', '%' + party)], limit=2)
-        if not parties:
-            raise UserError(
+        parties = defaultdict(list)
+        for sub_codes in grouped_slice(sorted(codes)):
+            if stats:
+                stats.call()
+            for party in Party.search([('code', 'in', list(sub_codes))]):
+                parties[party.code].append(party)
+        return parties
+
+    def get_party(self, party, parties):
+        found = parties.get(party)
+        if not found:
+            raise PartyError(
                 gettext('account_import_contaplus.msg_party_not_found' ,
                         party=party))
-        if (len(parties) > 1):
-            raise UserError(
+        if (len(found) > 1):
+            raise PartyError(
                 gettext('account_import_contaplus.msg_multiple_parties_found' ,
                         party=party))
-        return parties[0]
-
-    def get_account(self, account, company):
+        return found[0]
+
+    def get_mappings(self, company, stats=None):
+        'Return the account and the party of each mapped subcuenta'
+        Mapping = Pool().get('contaplus.mapping')
+        if stats:
+            stats.call()
+        return Mapping.get_mappings(company)
+
+    def get_accounts(self, codes, company, stats=None):
+        '''
+        Return a dictionary with the list of accounts for each code
+
+        The account ids of each code are cached per company, only the codes
+        not resolved yet are searched.
+        '''
         Account = Pool().get('account.account')
-        accounts = Account.search([('code', '=', account),
-                                   ('company', '=', company)], limit=2)
-        if not accounts:
-            raise UserError(
+        cache = self._resolve_cache
+        ids, missing = {}, []
+        for code in codes:
+            code_ids = cache.get(('account', company.id, code))
+            if code_ids is None:
+                missing.append(code)
+            else:
+                ids[code] = code_ids
+        for sub_codes in grouped_slice(sorted(missing)):
+            sub_codes = list(sub_codes)
+            found = defaultdict(list)
+            if stats:
+                stats.call()
+            for account in Account.search([
+                        ('code', 'in', sub_codes),
+                        ('company', '=', company),
+                        ]):
+                found[account.code].append(account.id)
+            for code in sub_codes:
+                ids[code] = found[code]
+                cache.set(('account', company.id, code), found[code])
+
+        # browse all the accounts together to read them at once
+        records = Account.browse(
+            [id_ for code_ids in ids.values() for id_ in code_ids])
+        records = {r.id: r for r in records}
+        accounts = defaultdict(list)
+        for code, code_ids in ids.items():
+            if code_ids:
+                accounts[code] = [records[id_] for id_ in code_ids]
+        return accounts
+
+    def get_account(self, account, accounts):
+        found = accounts.get(account)
+        if not found:
+            raise AccountError(
                 gettext('account_import_contaplus.msg_account_not_found' ,
                         account=account))
-        if (len(accounts) > 1):
-            raise UserError(
+        if (len(found) > 1):
+            raise AccountError(
                 gettext('account_import_contaplus.msg_multiple_accounts_found' ,
                         account=account))
-        return accounts[0]
+        return found[0]
 
-    def get_account_maybe(self, account, company):
-        Account = Pool().get('account.account')
-        accounts = Account.search([('code', '=', account),
-                                   ('company', '=', company)], limit=2)
-        if not accounts:
+    def get_account_maybe(self, account, accounts):
+        found = accounts.get(account)
+        if not found:
             return None
-        if (len(accounts) > 1):
+        if (len(found) > 1):
             return None
-        return accounts[0]
-
-    def import_moves(self, company, imp_record):
+        return found[0]
+
+    def get_periods(self, company, stats=None):
+        'Return the start dates and the standard periods of company'
+        Period = Pool().get('account.period')
+        if stats:
+            stats.call()
+        periods = Period.search([
+                ('fiscalyear.company', '=', company),
+                ('type', '=', 'standard'),
+                ], order=[('start_date', 'ASC')])
+        return [p.start_date for p in periods], periods
+
+    def get_period(self, date, periods, company, stats=None):
+        '''
+        Return the open period of periods for date.
+
+        Dates without an open period are delegated to Period.find so the same
+        errors are raised.
+        '''
+        Period = Pool().get('account.period')
+        starts, periods = periods
+        if date:
+            index = bisect_right(starts, date) - 1
+            if index >= 0:
+                period = periods[index]
+                if period.end_date >= date and period.state == 'open':
+                    return period
+        if stats:
+            stats.call()
+        return Period.find(company.id, date=date)
+
+    def commit_batch(self, documents, last, stats):
+        '''
+        Record the documents processed and commit them if requested.
+
+        last is the number of the last document which becomes the checkpoint
+        when committed. Documents to post later always get a checkpoint so a
+        failed posting resumes without importing them again.
+        '''
+        self.documents_processed += documents
+        if self.commit_batches or self.post_later:
+            self.checkpoint = last
+        self.save()
+        self.save_stats(stats)
+        if self.commit_batches:
+            Transaction().commit()
+
+    def save_moves(self, moves, lines, balances, stats):
+        '''
+        Check, save and post moves with their lines
+
+        moves and lines are the values of the moves and of their lines by
+        move number. They are created with Move.create when bulk_create is
+        set otherwise they are saved as instances.
+        '''
         pool = Pool()
         Move = pool.get('account.move')
         Line = pool.get('account.move.line')
-        Period = pool.get('account.period')
+        if any(not_balance(balances[n]) for n in moves):
+            raise UnbalanceError(
+                gettext('account_import_contaplus.msg_unbalance_lines'))
+        if moves:
+            with stats.phase('save', len(moves)):
+                stats.call()
+                if self.bulk_create:
+                    moves = Move.create([
+                            dict(values, lines=[('create', lines[number])])
+                            for number, values in moves.items()])
+                else:
+                    moves = [
+                        Move(lines=[Line(**v) for v in lines[number]],
+                            **values)
+                        for number, values in moves.items()]
+                    Move.save(moves)
+            if not self.post_later:
+                with stats.phase('post', len(moves)):
+                    stats.call()
+                    Move.post(moves)
+            with stats.phase('save'):
+                self.commit_batch(len(moves), moves[-1].number, stats)
+        return len(moves)
+
+    def get_move_line_account(self, iline, accounts, parties, mappings):
+        'Return the account and the party of the move line of iline'
+        sub_cta = iline.sub_cta.strip()
+        mapping = mappings.get(sub_cta)
+        if mapping:
+            return mapping
+        return self.get_subcuenta_account(sub_cta, accounts, parties)
+
+    def get_subcuenta_account(self, sub_cta, accounts, parties):
+        '''
+        Return the account and the party of the unmapped subcuenta sub_cta.
+
+        The customer and supplier subcuentas are the party with code
+        <company party code>-<subcuenta> on the main account.
+        '''
+        company = self.company
+        party = None
+        account = convert_account(sub_cta)
+
+        account_maybe = self.get_account_maybe(account, accounts)
+        party_required = (account_maybe is None) or \
+                         (account_maybe.party_required)
+
+        if party_required:
+            party = company.party.code + '-' + account
+            account = collapse_account(account)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('line account: %s requires party: %s party: %s',
+                account, party_required, party)
+
+        account = self.get_account(account, accounts)
+        if party:
+            party = self.get_party(party, parties)
+        return account, party
+
+    def import_moves(self, stats):
+        company = self.company
+        batch_size = self.batch_size
+        origin = str(self)
+        journal = self.journal.id
 
         total_credit = 0
         total_debit = 0
 
-        to_create = {}
         pre = "ALE-"
-        for iline in read(str(self.start.data, 'utf8')):
-            asien = pre + iline.asien
-
-            if asien not in to_create:
-                move = Move()
-                move.origin = imp_record
-                # move.origin_type =
-                move.number = asien
-
-                if len(Move.search(['number', '=', asien], limit=1)) > 0:
-                    raise UserError(
-                        gettext('account_import_contaplus.msg_number_exists' ,
+        with stats.phase('resolve'), self.open_data() as data:
+            mappings = self.get_mappings(company, stats)
+            codes, numbers = set(), set()
+            for sub_cta, asien in read_columns(data, ('sub_cta', 'asien')):
+                sub_cta = sub_cta.strip()
+                if sub_cta not in mappings:
+                    codes.add(convert_account(sub_cta))
+                numbers.add(pre + asien)
+            committed = self.get_committed(stats)
+            self.documents_processed = len(committed)
+            check_moves_not_exist(numbers - committed, company, stats)
+            accounts = self.get_accounts(
+                codes | set(map(collapse_account, codes)), company, stats)
+            parties = self.get_parties(
+                (company.party.code + '-' + code for code in codes), stats)
+            periods = self.get_periods(company, stats)
+
+        count = 0
+        saved = set()  # numbers of the moves of previous batches
+        # values of the moves and of their lines by number
+        to_create = {}
+        lines = defaultdict(list)
+        # credit and debit of each move
+        balances = defaultdict(lambda: [0, 0])
+        with stats.phase('build'), self.open_data() as data:
+            for iline in stats.iterate('parse', read(data)):
+                self.lines_processed += 1
+                asien = pre + iline.asien
+
+                if asien in committed:
+                    # keep the totals of the previous lines
+                    debit, credit = get_move_line_amounts(
+                        iline, total_debit, total_credit)
+                    total_debit += debit
+                    total_credit += credit
+                    continue
+
+                if asien not in to_create:
+                    if asien in saved:
+                        raise UserError(
+                            gettext('account_import_contaplus'
+                                '.msg_move_lines_not_consecutive',
                                 move_number=asien))
-
-                move.date = iline.fecha
-                move.period = Period.find(company.id, date=move.date)
-                to_create[move.number] = move
-                move.journal = self.start.journal
-                move.description = " ".join([iline.concepto, iline.documento])
-                move.lines = []
-
-            else:
-                move = to_create[move.number]
-
-            line = Line()
-            party = None
-            account = iline.sub_cta.strip()
-            account = convert_account(account)
-
-            account_maybe = self.get_account_maybe(account, company)
-            party_required = (account_maybe is None) or \
-                             (account_maybe.party_required)
-
-            if party_required:
-                party = company.party.code + '-' + account
-                if (account[:2] in ('40', '41', '43')):
-                    account = account[:2] + ('0' * 6)
-
-            line.account = self.get_account(account, company)
-
-            if party:
-                line.party = self.get_party(party)
-
-            logger.info('line account:' + account + 'requires party:' +
-                        str(line.account.party_required) + 'party:' +
-                        str(party))
-
-            # swap debe haber in some cases due to error.
-            # in caja the concepto/clave determines if it is debe or haber.
-            if iline.concepto.strip() in (
-                    '', 'TALON RTTE', 'CLAVE MANUAL', 'PAGO ITV', 'DESEMBOLSO',
-                    'TRASP. A BAN', 'TRASP. A BANC', 'ANTICP-VALES'):
-                line.debit = iline.euro_haber + iline.euro_debe
-                line.credit = 0
-            elif iline.concepto.strip() == 'cierre de caja':
-                if (total_credit > total_debit):
-                    line.debit = iline.euro_haber + iline.euro_debe
-                    line.credit = 0
-                else:
-                    line.credit = iline.euro_haber + iline.euro_debe
-                    line.debit = 0
-            else:
-                line.debit = iline.euro_debe
-                line.credit = iline.euro_haber
-
-            total_debit += line.debit
-            total_credit += line.credit
-
-            line.description = " ".join([iline.concepto, iline.documento])
-
-            move.lines = move.lines + (line, )
-
-        unbalance_moves = list(filter(not_balance, list(to_create.values())))
-        if (unbalance_moves):
-            raise UserError(
-                gettext('account_import_contaplus.msg_unbalance_lines'))
-        if to_create:
-            Move.save(list(to_create.values()))
-            Move.post(list(to_create.values()))
-        # return created moves
-        return to_create
-
-    def check_totals(self, invoices, totals):
-        for invoice in list(invoices.values()):
-            if not invoice.total_amount == totals[invoice.number]:
-                logger.info('unmatch total')
-                logger.info(invoice.total_amount)
-                logger.info(totals[invoice.number])
-                for line in invoice.lines:
-                    logger.info(line.unit_price)
-                raise UserError(
-                    gettext('account_import_contaplus.msg_unmatch_total_invoice' ,
-                            invoice=invoice.number))
+                    if batch_size and len(to_create) >= batch_size:
+                        count += self.save_moves(
+                            to_create, lines, balances, stats)
+                        saved.update(to_create)
+                        to_create = {}
+                        lines.clear()
+                        balances.clear()
+
+                    to_create[asien] = {
+                        'origin': origin,
+                        'number': asien,
+                        'date': iline.fecha,
+                        'period': self.get_period(
+                            iline.fecha, periods, company, stats).id,
+                        'journal': journal,
+                        'description': " ".join(
+                            [iline.concepto, iline.documento]),
+                        }
+
+                account, party = self.get_move_line_account(
+                    iline, accounts, parties, mappings)
+                debit, credit = get_move_line_amounts(
+                    iline, total_debit, total_credit)
+
+                total_debit += debit
+                total_credit += credit
+                balance = balances[asien]
+                balance[0] += credit
+                balance[1] += debit
+
+                lines[asien].append({
+                        'account': account.id,
+                        'party': party.id if party else None,
+                        'debit': debit,
+                        'credit': credit,
+                        'description': " ".join(
+                            [iline.concepto, iline.documento]),
+                        })
+
+        count += self.save_moves(to_create, lines, balances, stats)
+        # return the number of created moves
+        return count
+
+    def check_totals(self, invoices, totals, stats=None):
+        'Check the totals of the saved invoices with one read'
+        Invoice = Pool().get('account.invoice')
+        unmatched = []
+        for sub_ids in grouped_slice([i.id for i in invoices.values()]):
+            if stats:
+                stats.call()
+            for values in Invoice.read(
+                    list(sub_ids), ['number', 'total_amount']):
+                number = values['number']
+                if values['total_amount'] != totals.get(number):
+                    logger.debug('unmatch total %s: %s, expected %s',
+                        number, values['total_amount'], totals.get(number))
+                    unmatched.append(number)
+        if unmatched:
+            raise TotalError(
+                gettext('account_import_contaplus.msg_unmatch_total_invoices',
+                    invoices=', '.join(sorted(unmatched))))
         return True
 
     def add_tax_invoice(self, invoice, vat, vat_21):
@@ -379,174 +1522,511 @@ class AccountImportContaplus(Wizard):
             invoice.sii_issued_key = '02'
         return invoice
 
-
-
-    def import_invoices(self, company, imp_record):
+    def set_invoice_party(self, invoice, party, party_values):
+        '''
+        Set party on invoice with the values that depend on it.
+
+        The values changed by on_change_party are cached in party_values per
+        party and date as the account depends on the date of the invoice.
+        '''
+        invoice.party = party
+        key = (party.id,
+            getattr(invoice, 'accounting_date', None) or invoice.invoice_date)
+        values = party_values.get(key)
+        if values is None:
+            previous = dict(invoice._values._items())
+            invoice.on_change_party()
+            values = party_values[key] = {
+                name: value for name, value in invoice._values._items()
+                if name not in previous or previous[name] != value}
+        else:
+            for name, value in values.items():
+                setattr(invoice, name, value)
+
+    def set_invoice_payment_type(self, invoice, bank_accounts):
+        '''
+        Set the payment type of the party for the sign of invoice.
+
+        The bank account is computed by _get_bank_account once per party and
+        payment type and cached in bank_accounts.
+        '''
+        untaxed_amount = sum(
+            Decimal(line.quantity) * line.unit_price
+            for line in invoice.lines if line.quantity)
+        if untaxed_amount > 0:
+            payment_type = invoice.party.customer_payment_type
+        elif untaxed_amount < 0:
+            payment_type = invoice.party.supplier_payment_type
+        else:
+            payment_type = None
+        if not payment_type:
+            return
+        invoice.payment_type = payment_type
+        key = (invoice.party.id, payment_type.id)
+        if key not in bank_accounts:
+            invoice._get_bank_account()
+            bank_accounts[key] = getattr(invoice, 'bank_account', None)
+        else:
+            invoice.bank_account = bank_accounts[key]
+
+    def save_invoices(self, invoices, totals, bank_accounts, stats):
+        'Save, check and post invoices unless they are posted later'
+        Invoice = Pool().get('account.invoice')
+        if not invoices:
+            return 0
+        with stats.phase('build'):
+            # recalculate invoice fields
+            for invoice in invoices.values():
+                self.set_invoice_payment_type(invoice, bank_accounts)
+
+        to_save = list(invoices.values())
+        with stats.phase('save', len(to_save)):
+            stats.call()
+            Invoice.save(to_save)
+        with stats.phase('update_taxes', len(to_save)):
+            stats.call()
+            Invoice.update_taxes(to_save)
+        with stats.phase('check_totals', len(to_save)):
+            self.check_totals(invoices, totals, stats)
+        to_post = Invoice.browse(to_save)
+        if not self.post_later:
+            with stats.phase('post', len(to_post)):
+                stats.call()
+                Invoice.post(to_post)
+        with stats.phase('save'):
+            self.commit_batch(len(to_post), to_post[-1].number, stats)
+        return len(to_post)
+
+    def get_vats(self, stats=None):
+        'Return the taxes of 21% and exempt of the company'
         pool = Pool()
-        Invoice = pool.get('account.invoice')
-        Line = pool.get('account.invoice.line')
         ModelData = pool.get('ir.model.data')
         Tax = pool.get('account.tax')
         TaxTemplate = pool.get('account.tax.template')
 
-        logger.info("start import invoice")
+        key = ('vats', self.company.id)
+        vat_ids = self._resolve_cache.get(key)
+        if vat_ids is not None:
+            return Tax.browse(vat_ids)
 
         # TODO upgrade 4.7
         t_vat_21 = TaxTemplate(ModelData.get_id('account_es', 'iva_rep_21'))
         t_vat_0 = TaxTemplate(ModelData.get_id('account_es', 'iva_rep_ex'))
+        if stats:
+            stats.call(2)
         vat_21, = Tax.search([('template', '=', t_vat_21),
-                              ('company', '=', company)], limit=1)
+                              ('company', '=', self.company)], limit=1)
         vat_0, = Tax.search([('template', '=', t_vat_0),
-                             ('company', '=', company)], limit=1)
+                             ('company', '=', self.company)], limit=1)
+        self._resolve_cache.set(key, [vat_21.id, vat_0.id])
+        return vat_21, vat_0
+
+    @classmethod
+    def get_journal(cls, journal_type):
+        'Return the id of the first journal of journal_type'
+        Journal = Pool().get('account.journal')
+        key = ('journal', journal_type)
+        journal_id = cls._resolve_cache.get(key)
+        if journal_id is None:
+            journal_id = Journal.search(
+                [('type', '=', journal_type)], limit=1)[0].id
+            cls._resolve_cache.set(key, journal_id)
+        return journal_id
+
+    def get_invoice_party(self, iline, parties, mappings):
+        'Return the party of the customer line iline'
+        sub_cta = iline.sub_cta.strip()
+        mapping = mappings.get(sub_cta)
+        if mapping and mapping[1]:
+            party = mapping[1]
+        else:
+            party = self.get_party(
+                self.company.party.code + '-' + sub_cta, parties)
+
+        if (party.customer_payment_term is None):
+            raise PaymentTermError(
+                gettext('account_import_contaplus.msg_missing_payment_term' ,
+                        party=party.rec_name))
+        return party
+
+    def get_invoice_line_account(self, sub_cta, accounts, mappings):
+        'Return the account of the invoice line with subcuenta sub_cta'
+        mapping = mappings.get(sub_cta)
+        if mapping:
+            return mapping[0]
+        return self.get_account(sub_cta, accounts)
+
+    def import_invoices(self, stats):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
 
+        batch_size = self.batch_size
+
+        company = self.company
+
+        logger.debug("start import invoice")
+
+        with stats.phase('resolve'), self.open_data() as data:
+            vat_21, vat_0 = self.get_vats(stats)
+
+            mappings = self.get_mappings(company, stats)
+            codes, customers, numbers = set(), set(), set()
+            for sub_cta, serie, factura in read_columns(
+                    data, ('sub_cta', 'serie', 'factura')):
+                sub_cta = sub_cta.strip()
+                mapping = mappings.get(sub_cta)
+                if not mapping:
+                    codes.add(sub_cta)
+                # mappings without party use the party of the subcuenta
+                if sub_cta[:2] == '43' and not (mapping and mapping[1]):
+                    customers.add(sub_cta)
+                numbers.add(serie.strip() + factura.strip())
+            committed = self.get_committed(stats)
+            self.documents_processed = len(committed)
+            check_invoices_not_exist(
+                numbers - committed, company, stats)
+            accounts = self.get_accounts(codes, company, stats)
+            parties = self.get_parties((company.party.code + '-' + code
+                    for code in customers), stats)
+
+        count = 0
+        saved = set()  # numbers of the invoices of previous batches
+        party_values = {}
+        bank_accounts = {}
         to_create = {}
         vat = vat_0  # default vat no taxes
         totals = {}
         invoice = None  # current invoice
-        for iline in read(str(self.start.data, 'utf8')):
-            iline.factura = iline.factura.strip()
-            iline.serie = iline.serie.strip()
-            invoice_number = iline.serie + iline.factura
-            if invoice_number not in to_create:
-                # todo check num factura not alredy there.
-                check_invoice_not_exists(invoice_number, company)
-
-                if invoice:
-                    # check factura
-                    # if lines empty remove from to_create
-                    if len(invoice.lines) == 0:
-                        del to_create[invoice.number]
-
-                    self.add_tax_invoice(invoice, vat, vat_21)
-
-                vat = vat_0  # default vat no taxes
-                invoice = Invoice()
-                invoice.company = company
-                invoice.currency = company.currency
-                invoice.number = invoice_number
-                invoice.invoice_date = iline.fecha
-                invoice.type = 'out'
-                invoice.journal = self.start.journal
-                to_create[invoice.number] = invoice
-                invoice.lines = []
-
-            account = iline.sub_cta.strip()
-            if account[:2] == '43':
-                party_code = company.party.code + '-' + account
-                party = self.get_party(party_code)
-
-                if (party.customer_payment_term is None):
+        lines = []  # lines of the current invoice
+        with stats.phase('build'), self.open_data() as data:
+            for iline in stats.iterate('parse', read(data)):
+                self.lines_processed += 1
+                iline.factura = iline.factura.strip()
+                iline.serie = iline.serie.strip()
+                invoice_number = iline.serie + iline.factura
+                if invoice_number in committed:
+                    continue
+                if invoice_number in saved:
                     raise UserError(
-                        gettext('account_import_contaplus.msg_missing_payment_term' ,
-                                party=party.rec_name))
-
-                invoice.party = party
-                totals[invoice.number] = iline.euro_debe + iline.euro_haber
-                # abonos negatius
-                if iline.serie == 'A':
-                    totals[invoice.number] = totals[invoice.number] * -1
-
-                invoice.on_change_party()
-                invoice._update_account()
-                # on_change_party sets the payment term.
-                # invoice.payment_term = invoice.on_change_with_payment_term()
-
-            if account[:1] == '7' or account[:2] == '44':
-                line = Line()
-                line.account = self.get_account(iline.sub_cta.strip(), company)
-                line.quantity = 1
-
-                if iline.concepto.strip() == 'DIFERENCIA PORTE':
-                    line.unit_price = iline.euro_haber * -1
-                else:
-                    line.unit_price = iline.euro_haber
-                if iline.concepto.strip() == 'AVERIAS/FALTAS/R':
-                    line.taxes = [vat_0]
-                else:
-                    line.taxes = []
-                # abonos negatius
-                if iline.serie == 'A':
-                    line.unit_price = line.unit_price * -1
-                line.description = iline.concepto.strip()
-                invoice.lines = invoice.lines + (line, )
-
-            if account[:3] == '477':
-                vat = vat_21
-
-        # todo duplicated code
-        if invoice:
-            # check factura
-            # if lines empty remove from to_create
-            if len(invoice.lines) == 0:
-                del to_create[invoice.number]
-
-            self.add_tax_invoice(invoice, vat, vat_21)
-
-        invoices = []
-        if to_create:
-            # recalculate invoice fields
-            for k, invoice in list(to_create.items()):
-                untaxed_amount = sum(Decimal(line.quantity) * line.unit_price
-                    for line in invoice.lines if line.quantity)
-
-                # set payment type
-                if untaxed_amount > 0 and invoice.party.customer_payment_type:
-                    invoice.payment_type = invoice.party.customer_payment_type
-                    invoice._get_bank_account()
-                elif untaxed_amount < 0 and invoice.party.supplier_payment_type:
-                    invoice.payment_type = invoice.party.supplier_payment_type
-                    invoice._get_bank_account()
-                to_create[k] = invoice
-
-            logger.info("save")
-            Invoice.save(list(to_create.values()))
-            logger.info("update_taxes")
-            Invoice.update_taxes(list(to_create.values()))
-            logger.info("check total")
-            self.check_totals(to_create, totals)
-            logger.info("post")
-            #     logger.info("posting")
-            #     logger.info(inv.number)
-            #     logger.info(inv.party.name)
-            #     logger.info(inv.party.customer_payment_term.name)
-            #     logger.info(inv.payment_term.name)
-            #     Invoice.post([inv])
-            to_post = Invoice.browse(to_create.values())
-            Invoice.post(to_post)
-            invoices += to_post
-
-        return invoices
-
-    def create_import_record(self):
-        pool = Pool()
-        ImpRecord = pool.get('import.record')
-        Attachment = pool.get('ir.attachment')
+                        gettext('account_import_contaplus'
+                            '.msg_invoice_lines_not_consecutive',
+                            invoice_number=invoice_number))
+                if invoice_number not in to_create:
+                    if invoice:
+                        invoice.lines = lines
+                        # check factura
+                        # if lines empty remove from to_create
+                        if len(invoice.lines) == 0:
+                            del to_create[invoice.number]
+
+                        self.add_tax_invoice(invoice, vat, vat_21)
+
+                    if batch_size and len(to_create) >= batch_size:
+                        count += self.save_invoices(
+                            to_create, totals, bank_accounts, stats)
+                        saved.update(to_create)
+                        to_create = {}
+                        totals = {}
+
+                    vat = vat_0  # default vat no taxes
+                    invoice = Invoice()
+                    invoice.origin = self
+                    invoice.company = company
+                    invoice.currency = company.currency
+                    invoice.number = invoice_number
+                    invoice.invoice_date = iline.fecha
+                    invoice.type = 'out'
+                    invoice.journal = self.journal
+                    to_create[invoice.number] = invoice
+                    lines = []
+
+                account = iline.sub_cta.strip()
+                if account[:2] == '43':
+                    self.set_invoice_party(invoice,
+                        self.get_invoice_party(iline, parties, mappings),
+                        party_values)
+                    totals[invoice.number] = iline.euro_debe + iline.euro_haber
+                    # abonos negatius
+                    if iline.serie == 'A':
+                        totals[invoice.number] = totals[invoice.number] * -1
+
+                if account[:1] == '7' or account[:2] == '44':
+                    line = Line()
+                    line.account = self.get_invoice_line_account(
+                        account, accounts, mappings)
+                    line.quantity = 1
+                    line.unit_price = get_invoice_line_price(iline)
+                    if iline.concepto.strip() == 'AVERIAS/FALTAS/R':
+                        line.taxes = [vat_0]
+                    else:
+                        line.taxes = []
+                    line.description = iline.concepto.strip()
+                    lines.append(line)
+
+                if account[:3] == '477':
+                    vat = vat_21
+
+            # todo duplicated code
+            if invoice:
+                invoice.lines = lines
+                # check factura
+                # if lines empty remove from to_create
+                if len(invoice.lines) == 0:
+                    del to_create[invoice.number]
+
+                self.add_tax_invoice(invoice, vat, vat_21)
+
+        count += self.save_invoices(
+            to_create, totals, bank_accounts, stats)
+        # return the number of created invoices
+        return count
+
+
+
+class ContaplusMapping(ModelSQL, ModelView):
+    'Contaplus Mapping'
+    __name__ = 'contaplus.mapping'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    subcuenta = fields.Char('Subcuenta', required=True)
+    account = fields.Many2One('account.account', 'Account', required=True,
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            ])
+    party = fields.Many2One('party.party', 'Party')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('company_subcuenta_uniq', Unique(t, t.company, t.subcuenta),
+                'account_import_contaplus.msg_mapping_unique'),
+            ]
+        cls._order.insert(0, ('subcuenta', 'ASC'))
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def get_mappings(cls, company):
+        'Return a dictionary with the account and the party of each subcuenta'
+        return {m.subcuenta: (m.account, m.party) for m in cls.search([
+                    ('company', '=', company),
+                    ])}
+
+
+class ImportRecordPhase(ModelSQL, ModelView):
+    'Import Record Phase'
+    __name__ = 'import.record.phase'
+    record = fields.Many2One('import.record', 'Import Record', required=True,
+        ondelete='CASCADE')
+    phase = fields.Selection(PHASES, 'Phase', readonly=True)
+    duration = fields.Float('Duration (s)', digits=(16, 3), readonly=True)
+    count = fields.Integer('Count', readonly=True)
+    calls = fields.Integer('ORM Calls', readonly=True,
+        help="The searches, reads, saves and posts issued by the importer.")
+
+    def get_rec_name(self, name):
+        return '%s - %s' % (self.record.rec_name, dict(PHASES)[self.phase])
+
+
+class AccountImportContaplusStart(ModelView):
+    'Account Import Contaplus Start'
+    __name__ = 'account.import.contaplus.start'
+    name = fields.Char('Name', states={'readonly': True}, required=True)
+    data = fields.Binary('File', filename='name',
+        states={
+            'required': ~Eval('record'),
+            },
+        depends=['name'])
+    record = fields.Many2One('import.record', 'Import Record', readonly=True,
+        help="The import record which stores the uploaded file.")
+    is_invoice = fields.Boolean('Invoice?')
+    journal = fields.Many2One('account.journal', 'Journal', required=True)
+    batch_size = fields.Integer('Batch Size',
+        help="Number of documents saved and posted at once.\n"
+        "Leave empty to import the whole file at once.")
+    commit_batches = fields.Boolean('Commit Batches',
+        help="Commit each batch once posted.\n"
+        "If unchecked the whole file is imported or nothing is.")
+    bulk_create = fields.Boolean('Bulk Create',
+        states={
+            'invisible': Eval('is_invoice', False),
+            },
+        help="Create the account moves from their values in a single call "
+        "per batch instead of saving each record.")
+    post_later = fields.Boolean('Post Later',
+        help="Import the documents as draft and post them from the "
+        "scheduled task.")
+    collect_errors = fields.Boolean('Collect Errors',
+        help="Check the whole file before importing it and report all the "
+        "problems found at once.")
+    background = fields.Boolean('Run in Background',
+        help="Import the file from the queue and follow its progress on "
+        "the import record.")
+
+    @fields.depends('is_invoice')
+    def on_change_is_invoice(self):
+        ImportRecord = Pool().get('import.record')
+        journal_type = 'revenue' if self.is_invoice else 'general'
+        self.journal = ImportRecord.get_journal(journal_type)
+
+    @fields.depends('data')
+    def on_change_data(self):
+        self.is_invoice = bool(self.data) and is_invoice_file(self.data)
+        self.on_change_is_invoice()
+        if self.data:
+            self.record = None
+
+    @staticmethod
+    def default_batch_size():
+        return BATCH_SIZE or None
+
+    @staticmethod
+    def default_commit_batches():
+        return False
+
+    @staticmethod
+    def default_bulk_create():
+        return BULK_CREATE
+
+    @staticmethod
+    def default_post_later():
+        return False
 
-        imp_record = ImpRecord()
+    @staticmethod
+    def default_collect_errors():
+        return False
+
+    @staticmethod
+    def default_background():
+        return False
+
+    @staticmethod
+    def default_journal():
+        ImportRecord = Pool().get('import.record')
+        return ImportRecord.get_journal('general')
+
+
+class AccountImportContaplusValidation(ModelView):
+    'Account Import Contaplus Validation'
+    __name__ = 'account.import.contaplus.validation'
+    problems = fields.Text('Problems', readonly=True)
+
+
+class AccountImportContaplus(Wizard):
+    'Account Import Contaplus'
+    __name__ = 'account.import.contaplus'
+    start = StateView(
+        "account.import.contaplus.start",
+        'account_import_contaplus.account_import_contaplus_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Validate', 'validation', 'tryton-search'),
+            Button('Import', 'import_', 'tryton-ok', default=True)
+        ])
+    validation = StateView(
+        "account.import.contaplus.validation",
+        'account_import_contaplus.'
+        'account_import_contaplus_validation_view_form', [
+            Button('Back', 'start', 'tryton-back'),
+            Button('Import', 'import_', 'tryton-ok', default=True)
+        ])
+    import_ = StateTransition()
+
+    def get_company(self):
+        Company = Pool().get('company.company')
+        return Company(Transaction().context.get('company'))
+
+    def default_validation(self, fields):
+        imp_record = self.store_data()
+        if imp_record.state == 'draft':
+            self.get_import_record(self.get_company(), imp_record)
+        problems = imp_record.validate_file()
+        return {
+            'problems': format_problems(problems),
+            }
+
+    def get_import_record(self, company, imp_record=None):
+        'Return the import record with the start values, unsaved'
+        ImpRecord = Pool().get('import.record')
+
+        if imp_record is None:
+            imp_record = ImpRecord()
         imp_record.filename = self.start.name
+        imp_record.company = company
+        imp_record.journal = self.start.journal
+        imp_record.is_invoice = self.start.is_invoice
+        imp_record.batch_size = self.start.batch_size
+        imp_record.commit_batches = self.start.commit_batches
+        imp_record.bulk_create = self.start.bulk_create
+        imp_record.post_later = self.start.post_later
+        imp_record.collect_errors = self.start.collect_errors
+        return imp_record
+
+    def create_import_record(self, company):
+        ImpRecord = Pool().get('import.record')
+        file_hash = ImpRecord.hash_data(self.start.data)
+        ImpRecord.check_not_imported(company, file_hash)
+
+        # resume the failed import of the file with committed documents
+        failed = ImpRecord.search([
+                ('company', '=', company),
+                ('file_hash', '=', file_hash),
+                ('state', '=', 'failed'),
+                ('checkpoint', '!=', None),
+                ], order=[('id', 'DESC')], limit=1)
+        if failed:
+            return failed[0]
+
+        # reuse the draft of a retried transaction
+        drafts = ImpRecord.search([
+                ('company', '=', company),
+                ('file_hash', '=', file_hash),
+                ('state', '=', 'draft'),
+                ('create_uid', '=', Transaction().user),
+                ], order=[('id', 'DESC')], limit=1)
+        if drafts:
+            return drafts[0]
+
+        imp_record = self.get_import_record(company)
+        imp_record.state = 'draft'
+        imp_record.file_hash = file_hash
         imp_record.save()
+        imp_record.set_data(self.start.data)
+        return imp_record
 
-        attachment = Attachment()
-        attachment.name = imp_record.filename
-        attachment.resource = imp_record
-        attachment.data = self.start.data
-        attachment.save()
+    def store_data(self):
+        '''
+        Return the import record which stores the uploaded file.
 
-        return imp_record
+        The file is stored when it is received, then only the record is kept
+        in the wizard session.
+        '''
+        if self.start.data:
+            self.start.record = self.create_import_record(self.get_company())
+            self.start.data = None
+        return self.start.record
 
     def transition_import_(self):
-        pool = Pool()
-        Company = pool.get('company.company')
-
-        company_id = Transaction().context.get('company')
-        company = Company(company_id)
+        ImpRecord = Pool().get('import.record')
 
-        imp_record = self.create_import_record()
+        imp_record = self.store_data()
+        if imp_record.state == 'draft':
+            self.get_import_record(self.get_company(), imp_record)
 
-        if (self.start.is_invoice):
-            with Transaction().set_context(_skip_warnings=True):
-                self.import_invoices(company, imp_record)
+        if self.start.background:
+            imp_record.state = 'queued'
+            imp_record.save()
+            ImpRecord.__queue__.run_import([imp_record])
         else:
-            self.import_moves(company, imp_record)
+            imp_record.process()
 
         return 'end'
+
+    def end(self):
+        'Delete the file stored when the wizard is cancelled'
+        ImpRecord = Pool().get('import.record')
+        if self.start.record:
+            ImpRecord.delete_drafts([self.start.record])
@@ -0,0 +1,36 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.exceptions import UserError
+
+
+class ContaplusError(UserError):
+    'A problem of a Contaplus file, problem_type groups the reports'
+    problem_type = 'other'
+
+
+class InvalidLineError(ContaplusError):
+    problem_type = 'parse'
+
+
+class DuplicateError(ContaplusError):
+    problem_type = 'duplicate'
+
+
+class AccountError(ContaplusError):
+    problem_type = 'account'
+
+
+class PartyError(ContaplusError):
+    problem_type = 'party'
+
+
+class PaymentTermError(ContaplusError):
+    problem_type = 'payment_term'
+
+
+class UnbalanceError(ContaplusError):
+    problem_type = 'unbalance'
+
+
+class TotalError(ContaplusError):
+    problem_type = 'total'
@@ -87,6 +87,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         'Topic :: Office/Business',
         ],
     license='GPL-3',
+    scripts=['bin/trytond-import-contaplus'],
     install_requires=requires,
     zip_safe=False,
     entry_points="""
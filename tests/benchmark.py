@@ -0,0 +1,253 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Benchmarks of the Contaplus importer on synthetic files.
+
+Run with:
+
+    DB_NAME=:memory: python -m \\
+        trytond.modules.account_import_contaplus.tests.benchmark
+
+It reports the lines per second and the peak memory traced by tracemalloc of
+read(), import_moves and import_invoices for each size. The invoice importer
+uses fields of account_payment_type and aeat_sii so they must be given with
+--module to benchmark it.
+"""
+import argparse
+import datetime
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT, activate_module
+from trytond.transaction import Transaction, TransactionError
+
+from trytond.modules.account_import_contaplus.account import read
+from trytond.modules.account_import_contaplus.tests import generator
+
+SIZES = [1000, 10000, 100000]
+LINES_PER_ASIENTO = 4
+LINES_PER_INVOICE = 2
+ACCOUNTS = 100
+PARTIES = 100
+DATE = datetime.date(2024, 1, 1)
+
+
+def measure(function, memory=True):
+    'Return the seconds and the peak bytes of calling function'
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        function()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if memory else 0
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return elapsed, peak
+
+
+def moves_data(lines):
+    return generator.to_bytes(generator.generate_moves(
+            asientos=max(lines // LINES_PER_ASIENTO, 1),
+            lines_per_asiento=LINES_PER_ASIENTO, accounts=ACCOUNTS,
+            parties=PARTIES, date=DATE))
+
+
+def invoices_data(lines):
+    invoices = max(lines // (LINES_PER_INVOICE + 2), 1)
+    return generator.to_bytes(generator.generate_invoices(
+            invoices=invoices, lines_per_invoice=LINES_PER_INVOICE,
+            credit_notes=invoices // 10, accounts=ACCOUNTS, parties=PARTIES,
+            date=DATE))
+
+
+def setup_company():
+    'Create a company with the accounts, parties and taxes of the files'
+    from trytond.modules.company.tests import create_company, set_company
+    from trytond.modules.account.tests import create_chart, get_fiscalyear
+    from trytond.modules.account_invoice.tests import set_invoice_sequences
+
+    pool = Pool()
+    Account = pool.get('account.account')
+    AccountType = pool.get('account.account.type')
+    ModelData = pool.get('ir.model.data')
+    Party = pool.get('party.party')
+    PaymentTerm = pool.get('account.invoice.payment_term')
+    Tax = pool.get('account.tax')
+
+    company = create_company()
+    with set_company(company):
+        create_chart(company)
+        fiscalyear = set_invoice_sequences(get_fiscalyear(
+                company, start_date=DATE.replace(month=1, day=1),
+                end_date=DATE.replace(month=12, day=31)))
+        fiscalyear.save()
+        fiscalyear.create_period([fiscalyear])
+
+        def account_type(**domain):
+            type_, = AccountType.search(
+                [(k, '=', v) for k, v in domain.items()], limit=1)
+            return type_
+
+        receivable = account_type(receivable=True)
+        revenue = account_type(revenue=True)
+        expense = account_type(expense=True)
+        # taxes require a balance sheet account
+        payable = account_type(payable=True)
+        values = [{
+                'name': generator.VAT_ACCOUNT,
+                'code': generator.VAT_ACCOUNT,
+                'type': payable.id,
+                'company': company.id,
+                }]
+        values += [{
+                'name': code,
+                'code': code,
+                'type': expense.id,
+                'company': company.id,
+                } for code in [generator.BANK_ACCOUNT]
+            + [generator.expense_account(i) for i in range(ACCOUNTS)]]
+        values += [{
+                'name': generator.revenue_account(i),
+                'code': generator.revenue_account(i),
+                'type': revenue.id,
+                'company': company.id,
+                } for i in range(ACCOUNTS)]
+        values.append({
+                'name': generator.CUSTOMER_ACCOUNT,
+                'code': generator.CUSTOMER_ACCOUNT,
+                'type': receivable.id,
+                'party_required': True,
+                'company': company.id,
+                })
+        accounts = Account.create(values)
+        vat_account = accounts[0]
+
+        term, = PaymentTerm.create([{
+                    'name': 'Cash',
+                    'lines': [('create', [{'type': 'remainder'}])],
+                    }])
+        Party.create([{
+                    'name': generator.customer_account(i),
+                    'code': '%s-%s' % (
+                        company.party.code, generator.customer_account(i)),
+                    'customer_payment_term': term.id,
+                    } for i in range(PARTIES)])
+
+        for xml_id, rate in [
+                ('iva_rep_21', generator.VAT_RATE),
+                ('iva_rep_ex', Decimal(0))]:
+            Tax.create([{
+                        'name': xml_id,
+                        'description': xml_id,
+                        'type': 'percentage',
+                        'rate': rate,
+                        'invoice_account': vat_account.id,
+                        'credit_note_account': vat_account.id,
+                        'template': ModelData.get_id('account_es', xml_id),
+                        'company': company.id,
+                        }])
+    return company
+
+
+def import_file(company, data, is_invoice, batch_size, bulk_create):
+    pool = Pool()
+    ImportRecord = pool.get('import.record')
+    Journal = pool.get('account.journal')
+
+    journal, = Journal.search([
+            ('type', '=', 'revenue' if is_invoice else 'general'),
+            ], limit=1)
+    record = ImportRecord(
+        filename='benchmark', company=company, journal=journal,
+        is_invoice=is_invoice, batch_size=batch_size, commit_batches=False,
+        bulk_create=bulk_create)
+    record.save()
+    record.set_data(data)
+    return lambda: record.import_file()
+
+
+def run(benchmarks, sizes, batch_size, bulk_create, memory,
+        out=sys.stdout):
+    extras = {}
+
+    def execute(function):
+        '''
+        Return the result of function called in a transaction.
+
+        The transaction is started again with the locks requested, which are
+        kept for the next ones, as with_transaction does.
+        '''
+        while True:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT,
+                    **extras) as transaction:
+                try:
+                    return function()
+                except TransactionError as e:
+                    transaction.rollback()
+                    e.fix(extras)
+
+    out.write('%-10s %8s %12s %10s\n' % ('benchmark', 'lines', 'lines/s',
+            'peak MiB'))
+
+    def report(name, lines, elapsed, peak):
+        out.write('%-10s %8d %12.0f %10.1f\n' % (
+                name, lines, lines / elapsed, peak / 1024 / 1024))
+        out.flush()
+
+    company = execute(lambda: setup_company().id)
+
+    def benchmark(data, is_invoice):
+        transaction = Transaction()
+        try:
+            with transaction.set_context(company=company):
+                function = import_file(
+                    company, data, is_invoice, batch_size, bulk_create)
+                return measure(function, memory)
+        finally:
+            # keep the database the same for the next size
+            transaction.rollback()
+
+    for lines in sizes:
+        if 'read' in benchmarks:
+            data = moves_data(lines)
+            elapsed, peak = measure(
+                lambda: sum(1 for _ in read(data)), memory)
+            report('read', lines, elapsed, peak)
+        for name, data_function, is_invoice in [
+                ('moves', moves_data, False),
+                ('invoices', invoices_data, True)]:
+            if name not in benchmarks:
+                continue
+            data = data_function(lines)
+            elapsed, peak = execute(lambda: benchmark(data, is_invoice))
+            report(name, lines, elapsed, peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Contaplus importer.")
+    parser.add_argument('benchmarks', nargs='*',
+        choices=['read', 'moves', 'invoices'], default=['read', 'moves'])
+    parser.add_argument('--size', dest='sizes', type=int, action='append',
+        help="number of lines (default: %s)" % SIZES)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--bulk-create', action='store_true',
+        help="import the moves with Move.create")
+    parser.add_argument('--module', dest='modules', action='append',
+        default=[], help="module to activate with account_import_contaplus")
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+        help="do not trace memory, which slows down the benchmarks")
+    options = parser.parse_args()
+
+    activate_module(['account_import_contaplus'] + options.modules)
+    run(options.benchmarks, options.sizes or SIZES, options.batch_size,
+        options.bulk_create, options.memory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Synthetic Contaplus files for tests and benchmarks.
+
+The files are made of ENTRY_RECORD lines. Subcuentas starting with 43 are
+customers, the importer resolves them to the party with code
+<company party code>-<subcuenta> and the account 43000000.
+"""
+import datetime
+from decimal import Decimal
+
+from retrofix.fields import Date, Integer
+
+from trytond.modules.account_import_contaplus.account import (
+    ENTRY_RECORD, DecimalField)
+
+BANK_ACCOUNT = '57200000'
+CUSTOMER_ACCOUNT = '43000000'
+VAT_ACCOUNT = '47700000'
+VAT_RATE = Decimal('0.21')
+
+
+def expense_account(index):
+    return '6290%04d' % index
+
+
+def revenue_account(index):
+    return '7000%04d' % index
+
+
+def customer_account(index):
+    # 43000000 is the main account so customers start at 1
+    return '4300%04d' % (index + 1)
+
+
+def format_line(**values):
+    'Return an ENTRY_RECORD line with values, the other fields are empty'
+    parts = []
+    for _, size, name, field in ENTRY_RECORD:
+        value = values.get(name)
+        if field is DecimalField:
+            text = ('%.2f' % (value or 0)).rjust(size)
+        elif field is Integer:
+            text = str(value or 0).rjust(size, '0')
+        elif isinstance(field, Date):
+            text = value.strftime('%Y%m%d')
+        else:
+            text = (value or '').ljust(size)[:size]
+        parts.append(text)
+    return ''.join(parts)
+
+
+def generate_moves(asientos=100, lines_per_asiento=4, accounts=10,
+        parties=10, date=None, start=1):
+    '''
+    Yield the lines of a diario file.
+
+    Each asiento has lines_per_asiento - 1 debit lines, alternating between
+    accounts expense accounts and parties customers, and a credit line on
+    the bank that balances it. The asientos are numbered from start.
+    '''
+    assert lines_per_asiento >= 2
+    if date is None:
+        date = datetime.date(2024, 1, 1)
+    line = customer = expense = 0
+    for asiento in range(asientos):
+        number = '%06d' % (asiento + start)
+        total = Decimal(0)
+        for _ in range(lines_per_asiento - 1):
+            if parties and (not accounts or line % 2):
+                sub_cta = customer_account(customer % parties)
+                customer += 1
+            else:
+                sub_cta = expense_account(expense % accounts)
+                expense += 1
+            amount = Decimal(line % 97 + 1)
+            total += amount
+            line += 1
+            yield format_line(asien=number, fecha=date, sub_cta=sub_cta,
+                concepto='BENCH', documento=number, euro_debe=amount)
+        yield format_line(asien=number, fecha=date, sub_cta=BANK_ACCOUNT,
+            concepto='BENCH', documento=number, euro_haber=total)
+
+
+def generate_invoices(invoices=100, lines_per_invoice=2, credit_notes=0,
+        accounts=10, parties=10, date=None):
+    '''
+    Yield the lines of a facturas file.
+
+    Each invoice has a customer line with the total, lines_per_invoice
+    revenue lines and a VAT line. The last credit_notes invoices are serie
+    'A' credit notes.
+    '''
+    assert parties and accounts
+    if date is None:
+        date = datetime.date(2024, 1, 1)
+    line = 0
+    for invoice in range(invoices):
+        serie = 'A' if invoice >= invoices - credit_notes else ''
+        number = '%08d' % (invoice + 1)
+        bases = []
+        for _ in range(lines_per_invoice):
+            bases.append(Decimal(line % 97 + 1))
+            line += 1
+        base = sum(bases)
+        vat = (base * VAT_RATE).quantize(Decimal('0.01'))
+        values = {
+            'asien': '%06d' % (invoice + 1),
+            'fecha': date,
+            'factura': number,
+            'serie': serie,
+            'concepto': 'BENCH',
+            'documento': number,
+            }
+        yield format_line(sub_cta=customer_account(invoice % parties),
+            contra=revenue_account(0), euro_debe=base + vat, **values)
+        for index, amount in enumerate(bases):
+            yield format_line(
+                sub_cta=revenue_account((invoice + index) % accounts),
+                contra=customer_account(invoice % parties), euro_haber=amount,
+                base_impo=amount, **values)
+        yield format_line(sub_cta=VAT_ACCOUNT,
+            contra=customer_account(invoice % parties), euro_haber=vat,
+            base_impo=base, iva=VAT_RATE * 100, **values)
+
+
+def to_bytes(lines):
+    'Return lines as the content of a file'
+    return ''.join(line + '\r\n' for line in lines).encode('utf8')
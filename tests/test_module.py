@@ -1,11 +1,169 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import csv
+import datetime
+import importlib.machinery
+import importlib.util
+import io
+import os
+import tempfile
 import unittest
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.tests.test_tryton import (
+    DB_NAME, USER, CONTEXT, ModuleTestCase, with_transaction)
+from trytond.exceptions import UserError
 from trytond.pool import Pool
+from trytond.transaction import Transaction, TransactionError
 from decimal import Decimal
 
+from retrofix.exception import RetrofixException
+from retrofix.record import Record
+
+from trytond.modules.account_import_contaplus.account import (
+    ENTRY_RECORD, check_moves_not_exist, format_problems,
+    get_move_line_amounts, is_invoice_file, problem_type, read, read_all)
+from trytond.modules.account_import_contaplus.exceptions import (
+    AccountError, InvalidLineError)
+from trytond.modules.account_import_contaplus.tests import generator
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.company.tests import create_company, set_company
+
+ENTRY_LINE = (
+    '0000012024013143000001                            0.00FRA 1     '
+    '                           0.00     123          100.0021.00 0.0'
+    '0DOC                 0000000000000            0.00            0.'
+    '00            0.00 A                     0.002          121.00  '
+    '          0.00          100.00           ')
+
+DATE = datetime.date(2024, 1, 1)
+ACCOUNTS = 3
+PARTIES = 3
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'bin',
+    'trytond-import-contaplus')
+
+
+def create_import_company():
+    'Create a company with the accounts, parties and periods of the files'
+    pool = Pool()
+    Account = pool.get('account.account')
+    AccountType = pool.get('account.account.type')
+    Party = pool.get('party.party')
+
+    company = create_company()
+    with set_company(company):
+        create_chart(company)
+        fiscalyear = get_fiscalyear(company, today=DATE)
+        fiscalyear.save()
+        fiscalyear.create_period([fiscalyear])
+
+        expense, = AccountType.search([
+                ('expense', '=', True),
+                ('company', '=', company),
+                ], limit=1)
+        receivable, = AccountType.search([
+                ('receivable', '=', True),
+                ('company', '=', company),
+                ], limit=1)
+        Account.create([{
+                    'name': code,
+                    'code': code,
+                    'type': expense.id,
+                    'company': company.id,
+                    } for code in [generator.BANK_ACCOUNT]
+                + [generator.expense_account(i) for i in range(ACCOUNTS)]]
+            + [{
+                    'name': generator.CUSTOMER_ACCOUNT,
+                    'code': generator.CUSTOMER_ACCOUNT,
+                    'type': receivable.id,
+                    'party_required': True,
+                    'company': company.id,
+                    }])
+        Party.create([{
+                    'name': generator.customer_account(i),
+                    'code': '%s-%s' % (
+                        company.party.code, generator.customer_account(i)),
+                    } for i in range(PARTIES)])
+    return company
+
+
+def moves_data(asientos=5, **values):
+    return generator.to_bytes(generator.generate_moves(asientos=asientos,
+            lines_per_asiento=3, accounts=ACCOUNTS, parties=PARTIES,
+            date=DATE, **values))
+
+
+def create_journal_period(journal, company):
+    '''
+    Create the journal period of the files.
+
+    It requires a lock which must be taken before the tests commit.
+    '''
+    pool = Pool()
+    Period = pool.get('account.period')
+    JournalPeriod = pool.get('account.journal.period')
+
+    JournalPeriod.lock()
+    JournalPeriod.create([{
+                'journal': journal.id,
+                'period': Period.find(company, date=DATE),
+                }])
+
+
+def run_tasks():
+    'Run the tasks queued by the transaction'
+    pool = Pool()
+    Queue = pool.get('ir.queue')
+    transaction = Transaction()
+    while transaction.tasks:
+        task = Queue(transaction.tasks.pop())
+        task.run()
+
+
+def execute(function):
+    '''
+    Return the result of function called in a committed transaction.
+
+    The transaction is started again with the locks requested and its context
+    has the preferences of the user, as the dispatcher does.
+    '''
+    extras = {}
+    while True:
+        with Transaction().start(DB_NAME, USER, context=CONTEXT,
+                **extras) as transaction:
+            User = Pool().get('res.user')
+            try:
+                with transaction.set_context(
+                        User.get_preferences(context_only=True)):
+                    return function()
+            except TransactionError as e:
+                transaction.rollback()
+                e.fix(extras)
+
+
+def load_script():
+    'Return the command line script as a module'
+    loader = importlib.machinery.SourceFileLoader(
+        'trytond_import_contaplus', SCRIPT)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def create_import_record(company, data, **values):
+    'Return an import record of company with data as the moves file'
+    pool = Pool()
+    ImportRecord = pool.get('import.record')
+    Journal = pool.get('account.journal')
+
+    journal, = Journal.search([('type', '=', 'general')], limit=1)
+    values.setdefault('batch_size', 2)
+    record = ImportRecord(filename='moves.txt', company=company,
+        journal=journal, is_invoice=False, **values)
+    record.save()
+    record.set_data(data)
+    return record
+
 
 class AccountImportContaplusTestCase(ModuleTestCase):
     'Test Account Import Contaplus module'
@@ -23,5 +181,546 @@ class AccountImportContaplusTestCase(ModuleTestCase):
         self.assertEqual(t_vat_21.rate * 100, Decimal('21.00'))
         self.assertEqual(t_vat_0.rate * 100, Decimal(0))
 
+    def test_read_line(self):
+        'Test parsed lines match retrofix records'
+        record = Record.extract(ENTRY_LINE, ENTRY_RECORD)
+        line, = read_all(ENTRY_LINE)
+        for _, _, name, _ in ENTRY_RECORD:
+            self.assertEqual(getattr(line, name), getattr(record, name))
+
+        self.assertEqual(len(list(read(ENTRY_LINE))), 1)
+        self.assertEqual(
+            len(list(read(ENTRY_LINE[:14] + ' ' * 12 + ENTRY_LINE[26:]))), 0)
+
+        with self.assertRaises(RetrofixException):
+            list(read_all(ENTRY_LINE.replace('20240131', '2024xx31')))
+
+    def test_read_bytes(self):
+        'Test reading lines from bytes and file-like objects'
+        data = b'\r\n'.join([ENTRY_LINE.encode('utf8')] * 3) + b'\r\n'
+        self.assertEqual(len(list(read(data))), 3)
+        self.assertEqual(len(list(read(io.BytesIO(data)))), 3)
+        with self.assertRaises(UserError):
+            list(read_all(b'\xff' + data))
+
+    def test_move_line_amounts(self):
+        'Test debit and credit of move lines'
+        line, = read_all(ENTRY_LINE)
+        self.assertEqual(
+            get_move_line_amounts(line, 0, 0),
+            (Decimal('121.00'), Decimal('0.00')))
+
+        line.concepto = 'TALON RTTE'
+        self.assertEqual(
+            get_move_line_amounts(line, 0, 0), (Decimal('121.00'), 0))
+
+        line.concepto = 'cierre de caja'
+        self.assertEqual(
+            get_move_line_amounts(line, 0, 10), (Decimal('121.00'), 0))
+        self.assertEqual(
+            get_move_line_amounts(line, 10, 0), (0, Decimal('121.00')))
+
+    def test_problem_type(self):
+        'Test the type of the problems reported by exceptions'
+        self.assertEqual(problem_type(AccountError('account')), 'account')
+        self.assertEqual(problem_type(UserError('other')), 'other')
+        with self.assertRaises(InvalidLineError) as cm:
+            list(read_all(ENTRY_LINE.replace('121.00', '121,00')))
+        self.assertEqual(problem_type(cm.exception), 'parse')
+
+    def test_generator(self):
+        'Test synthetic files are read back'
+        data = generator.to_bytes(generator.generate_moves(
+                asientos=10, lines_per_asiento=3))
+        lines = list(read(data))
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(sum(l.euro_debe for l in lines),
+            sum(l.euro_haber for l in lines))
+        self.assertFalse(is_invoice_file(data))
+
+        data = generator.to_bytes(generator.generate_invoices(
+                invoices=10, lines_per_invoice=2, credit_notes=2))
+        lines = list(read(data))
+        self.assertEqual(len(lines), 40)
+        self.assertEqual(len([l for l in lines if l.serie == 'A']), 8)
+        self.assertTrue(is_invoice_file(data))
+        self.assertTrue(is_invoice_file(memoryview(data), sample_size=400))
+        self.assertFalse(is_invoice_file(data, sample_size=200))
+
+    @with_transaction()
+    def test_hash_file(self):
+        'Test hashing a file in chunks'
+        pool = Pool()
+        ImportRecord = pool.get('import.record')
+
+        data = moves_data(asientos=10000)
+        self.assertGreater(len(data), 1024 * 1024)
+        self.assertEqual(ImportRecord.hash_file(io.BytesIO(data)),
+            ImportRecord.hash_data(data))
+
+    @with_transaction()
+    def test_check_moves_not_exist(self):
+        'Test duplicated move numbers are searched in the company'
+        pool = Pool()
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+
+        other = create_import_company()
+        company = create_import_company()
+        with set_company(company):
+            journal, = Journal.search([('type', '=', 'general')], limit=1)
+            Move.create([{
+                        'company': company.id,
+                        'journal': journal.id,
+                        'period': Period.find(company, date=DATE),
+                        'date': DATE,
+                        'number': 'ALE-000001',
+                        }])
+
+            check_moves_not_exist({'ALE-000001', 'ALE-000002'}, other)
+            with self.assertRaises(UserError) as cm:
+                check_moves_not_exist({'ALE-000001', 'ALE-000002'}, company)
+            self.assertIn('ALE-000001', cm.exception.message)
+            self.assertNotIn('ALE-000002', cm.exception.message)
+
+    @with_transaction()
+    def test_import_moves(self):
+        'Test import moves'
+        pool = Pool()
+        Move = pool.get('account.move')
+
+        company = create_import_company()
+        with set_company(company):
+            record = create_import_record(company, moves_data())
+            record.import_file()
+
+            self.assertEqual(record.state, 'done')
+            self.assertEqual(record.lines_processed, 15)
+            self.assertEqual(record.documents_processed, 5)
+            moves = Move.search([('origin', '=', str(record))])
+            self.assertEqual(len(moves), 5)
+            self.assertEqual({m.state for m in moves}, {'posted'})
+            self.assertEqual(
+                {p.phase for p in record.phases} >= {'parse', 'save'}, True)
+
+    @with_transaction()
+    def test_import_moves_bulk_create(self):
+        'Test import moves with bulk create'
+        pool = Pool()
+        Move = pool.get('account.move')
+
+        company = create_import_company()
+        with set_company(company):
+            record = create_import_record(company, moves_data(),
+                bulk_create=True)
+            record.import_file()
+
+            self.assertEqual(record.state, 'done')
+            moves = Move.search([('origin', '=', str(record))])
+            self.assertEqual(len(moves), 5)
+            self.assertEqual(sum(len(m.lines) for m in moves), 15)
+            self.assertEqual({m.state for m in moves}, {'posted'})
+
+    @with_transaction()
+    def test_import_collect_errors(self):
+        'Test import collecting errors raises all the problems'
+        pool = Pool()
+        Move = pool.get('account.move')
+
+        company = create_import_company()
+        with set_company(company):
+            lines = list(generator.generate_moves(asientos=2,
+                    lines_per_asiento=3, accounts=ACCOUNTS, parties=PARTIES,
+                    date=DATE))
+            lines.append(generator.format_line(asien='000003', fecha=DATE,
+                    sub_cta='62999999', euro_debe=Decimal(10)))
+            record = create_import_record(company, generator.to_bytes(lines),
+                collect_errors=True)
+
+            with self.assertRaises(UserError) as cm:
+                record.import_file()
+            self.assertIn('62999999', cm.exception.message)
+            self.assertIn('ALE-000003', cm.exception.message)
+            self.assertEqual(
+                Move.search_count([('origin', '=', str(record))]), 0)
+
+    @with_transaction()
+    def test_import_post_later(self):
+        'Test import moves to post later'
+        pool = Pool()
+        ImportRecord = pool.get('import.record')
+        Move = pool.get('account.move')
+
+        company = create_import_company()
+        with set_company(company):
+            record = create_import_record(company, moves_data(start=201),
+                post_later=True)
+            record.import_file()
+
+            self.assertEqual(record.state, 'posting')
+            self.assertEqual(record.checkpoint, 'ALE-000205')
+            moves = Move.search([('origin', '=', str(record))])
+            self.assertEqual({m.state for m in moves}, {'draft'})
+
+            ImportRecord.post_imported()
+
+            record = ImportRecord(record.id)
+            self.assertEqual(record.state, 'done')
+            self.assertEqual(record.documents_posted, 5)
+            moves = Move.search([('origin', '=', str(record))])
+            self.assertEqual({m.state for m in moves}, {'posted'})
+
+    @with_transaction()
+    def test_resume(self):
+        'Test resume a failed import from its checkpoint'
+        pool = Pool()
+        Account = pool.get('account.account')
+        ImportRecord = pool.get('import.record')
+        Move = pool.get('account.move')
+
+        company = create_import_company()
+        with set_company(company):
+            lines = list(generator.generate_moves(asientos=4,
+                    lines_per_asiento=3, accounts=ACCOUNTS, parties=PARTIES,
+                    date=DATE, start=101))
+            lines.append(generator.format_line(asien='000105', fecha=DATE,
+                    sub_cta='62999999', concepto='TEST',
+                    euro_debe=Decimal(10)))
+            lines.append(generator.format_line(asien='000105', fecha=DATE,
+                    sub_cta=generator.BANK_ACCOUNT, concepto='TEST',
+                    euro_haber=Decimal(10)))
+            record = create_import_record(company, generator.to_bytes(lines),
+                commit_batches=True)
+            create_journal_period(record.journal, company)
+
+            with self.assertRaises(UserError):
+                record.process()
+
+            record = ImportRecord(record.id)
+            self.assertEqual(record.state, 'failed')
+            self.assertTrue(record.error_message)
+            self.assertEqual(record.checkpoint, 'ALE-000104')
+            self.assertEqual(
+                Move.search_count([('origin', '=', str(record))]), 4)
+
+            account, = Account.search([
+                    ('code', '=', generator.expense_account(0)),
+                    ('company', '=', company),
+                    ])
+            Account.copy([account], default={
+                    'code': '62999999',
+                    'name': '62999999',
+                    })
+            ImportRecord.resume([record])
+            run_tasks()
+
+            record = ImportRecord(record.id)
+            self.assertEqual(record.state, 'done')
+            self.assertEqual(record.checkpoint, 'ALE-000105')
+            self.assertEqual(
+                Move.search_count([('origin', '=', str(record))]), 5)
+
+    @with_transaction()
+    def test_create_mappings(self):
+        'Test create the mappings of an imported file'
+        pool = Pool()
+        ImportRecord = pool.get('import.record')
+        Mapping = pool.get('contaplus.mapping')
+
+        company = create_import_company()
+        with set_company(company):
+            record = create_import_record(company, moves_data())
+            record.import_file()
+
+            ImportRecord.create_mappings([record])
+
+            mappings = Mapping.get_mappings(company)
+            self.assertEqual(len(mappings), 1 + ACCOUNTS + PARTIES)
+            account, party = mappings[generator.customer_account(0)]
+            self.assertEqual(account.code, generator.CUSTOMER_ACCOUNT)
+            self.assertEqual(party.code, '%s-%s' % (
+                    company.party.code, generator.customer_account(0)))
+            account, party = mappings[generator.BANK_ACCOUNT]
+            self.assertEqual(account.code, generator.BANK_ACCOUNT)
+            self.assertIsNone(party)
+
+            # existing mappings are not created again
+            ImportRecord.create_mappings([record])
+            self.assertEqual(Mapping.search_count([
+                        ('company', '=', company),
+                        ]), 1 + ACCOUNTS + PARTIES)
+
+    @with_transaction()
+    def test_wizard(self):
+        'Test validate and import with the wizard'
+        pool = Pool()
+        ImportRecord = pool.get('import.record')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Wizard = pool.get('account.import.contaplus', type='wizard')
+
+        company = create_import_company()
+        with set_company(company):
+            journal, = Journal.search([('type', '=', 'general')], limit=1)
+            create_journal_period(journal, company)
+
+            def start(data):
+                session_id, _, _ = Wizard.create()
+                wizard = Wizard(session_id)
+                wizard.start.name = 'moves.txt'
+                wizard.start.data = data
+                wizard.start.is_invoice = False
+                wizard.start.journal = journal
+                wizard.start.batch_size = 2
+                wizard.start.commit_batches = False
+                wizard.start.bulk_create = False
+                wizard.start.post_later = False
+                wizard.start.collect_errors = False
+                wizard.start.background = False
+                return wizard
+
+            # cancel after validating deletes the stored file
+            wizard = start(moves_data(start=301))
+            self.assertEqual(wizard.default_validation(None),
+                {'problems': format_problems([])})
+            record = wizard.start.record
+            self.assertEqual(record.state, 'draft')
+            wizard.end()
+            self.assertFalse(ImportRecord.search([('id', '=', record.id)]))
+
+            wizard = start(moves_data(start=311))
+            wizard.default_validation(None)
+            self.assertEqual(wizard.transition_import_(), 'end')
+            wizard.end()
+
+            record = ImportRecord(wizard.start.record.id)
+            self.assertEqual(record.state, 'done')
+            self.assertEqual(
+                Move.search_count([('origin', '=', str(record))]), 5)
+
+            # the same file is not imported again
+            with self.assertRaises(UserError):
+                start(moves_data(start=311)).default_validation(None)
+
+    @with_transaction()
+    def test_set_invoice_party(self):
+        'Test invoice party values are shared only for the same date'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+
+        company = create_import_company()
+        with set_company(company):
+            receivable, = Account.search([
+                    ('code', '=', generator.CUSTOMER_ACCOUNT),
+                    ('company', '=', company),
+                    ])
+            receivable.start_date = datetime.date(2024, 7, 1)
+            receivable.save()
+            party = Party(name='Customer', account_receivable=receivable)
+            party.save()
+            record = create_import_record(company, moves_data())
+
+            party_values = {}
+            invoices = []
+            for date in [DATE, datetime.date(2024, 7, 1), DATE]:
+                invoice = Invoice(company=company, type='out',
+                    invoice_date=date)
+                record.set_invoice_party(invoice, party, party_values)
+                invoices.append(invoice)
+
+            self.assertEqual(len(party_values), 2)
+            self.assertEqual([i.account for i in invoices],
+                [None, receivable, None])
+            self.assertEqual(
+                invoices[2].invoice_address, party.address_get('invoice'))
+
+    @with_transaction()
+    def test_validate_file(self):
+        'Test validate file reports all the problems'
+        company = create_import_company()
+        with set_company(company):
+            lines = list(generator.generate_moves(asientos=2,
+                    lines_per_asiento=3, accounts=ACCOUNTS, parties=PARTIES,
+                    date=DATE))
+            lines.append(generator.format_line(asien='000003', fecha=DATE,
+                    sub_cta='62999999', euro_debe=Decimal(10)))
+            record = create_import_record(company, generator.to_bytes(lines))
+
+            problems = record.validate_file()
+
+            self.assertEqual(
+                sorted((p['line'], p['document'], p['type'])
+                    for p in problems),
+                [(7, 'ALE-000003', 'account'),
+                    (7, 'ALE-000003', 'unbalance')])
+            self.assertEqual(record.validate_file(), problems)
+
+    @with_transaction()
+    def test_delete_drafts(self):
+        'Test delete drafts with their attachment'
+        pool = Pool()
+        ImportRecord = pool.get('import.record')
+        Attachment = pool.get('ir.attachment')
+
+        company = create_import_company()
+        with set_company(company):
+            data = moves_data()
+            draft = create_import_record(company, data, state='draft')
+            record = create_import_record(company, data)
+
+            ImportRecord.delete_drafts([draft, record])
+
+            self.assertFalse(ImportRecord.search([('id', '=', draft.id)]))
+            self.assertEqual(Attachment.search_count([
+                        ('resource', '=', str(draft)),
+                        ]), 0)
+            self.assertEqual(record.get_data(), data)
+
+    @with_transaction()
+    def test_open_data_store_prefix(self):
+        'Test open the file stored with the store prefix of attachments'
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+
+        company = create_import_company()
+        with set_company(company):
+            data = moves_data()
+            store_prefix = Attachment.data.store_prefix
+            Attachment.data.store_prefix = 'contaplus'
+            try:
+                record = create_import_record(company, data)
+                with record.open_data() as f:
+                    self.assertEqual(f.read(), data)
+            finally:
+                Attachment.data.store_prefix = store_prefix
+
+    @with_transaction()
+    def test_validate_file_encoding(self):
+        'Test validate and import a file which is not UTF-8'
+        company = create_import_company()
+        with set_company(company):
+            record = create_import_record(company,
+                moves_data() + b'\xff\r\n', collect_errors=True)
+
+            problems = record.validate_file()
+
+            self.assertEqual(
+                [(p['line'], p['document'], p['type']) for p in problems],
+                [(None, None, 'parse')])
+            with self.assertRaises(UserError) as cm:
+                record.import_file()
+            self.assertIn(format_problems(problems), cm.exception.message)
+
+    @with_transaction()
+    def test_resolve_cache(self):
+        'Test the accounts resolved are cleared when accounts are modified'
+        pool = Pool()
+        Account = pool.get('account.account')
+
+        company = create_import_company()
+        with set_company(company):
+            record = create_import_record(company, moves_data())
+            self.assertFalse(record.get_accounts(['62999999'], company))
+
+            account, = Account.search([
+                    ('code', '=', generator.expense_account(0)),
+                    ('company', '=', company),
+                    ])
+            copy, = Account.copy([account], default={
+                    'code': '62999999',
+                    'name': '62999999',
+                    })
+            self.assertEqual(
+                record.get_accounts(['62999999'], company)['62999999'],
+                [copy])
+
+            copy.code = '62999998'
+            copy.save()
+            self.assertFalse(record.get_accounts(['62999999'], company))
+
+    def test_wizard_retry(self):
+        'Test import with the wizard retried on transaction errors'
+        pool = Pool(DB_NAME)
+        ImportRecord = pool.get('import.record')
+        Journal = pool.get('account.journal')
+        Move = pool.get('account.move')
+        Wizard = pool.get('account.import.contaplus', type='wizard')
+
+        # the company of the user, its journal period is created by the import
+        company_id = execute(lambda: create_import_company().id)
+        journal_id = execute(lambda: Journal.search([
+                    ('type', '=', 'general'),
+                    ], limit=1)[0].id)
+        data = moves_data(start=321)
+        session_id = execute(lambda: Wizard.create()[0])
+        start = {
+            'name': 'moves.txt',
+            'data': data,
+            'is_invoice': False,
+            'journal': journal_id,
+            'batch_size': 2,
+            'commit_batches': False,
+            'bulk_create': False,
+            'post_later': False,
+            'collect_errors': False,
+            'background': False,
+            }
+        execute(
+            lambda: Wizard.execute(session_id, {'start': start}, 'import_'))
+        execute(lambda: Wizard.delete(session_id))
+
+        def check():
+            record, = ImportRecord.search([
+                    ('company', '=', company_id),
+                    ('file_hash', '=', ImportRecord.hash_data(data)),
+                    ])
+            self.assertEqual(record.state, 'done')
+            self.assertEqual(
+                Move.search_count([('origin', '=', str(record))]), 5)
+        execute(check)
+
+    def test_command_line(self):
+        'Test import the files of a manifest from the command line'
+        pool = Pool(DB_NAME)
+        Company = pool.get('company.company')
+        Journal = pool.get('account.journal')
+
+        if not os.path.isfile(SCRIPT):
+            self.skipTest("command line script not found")
+        script = load_script()
+
+        # the journal period is created by the import
+        company_id = execute(lambda: create_import_company().id)
+        company_code = execute(lambda: Company(company_id).party.code)
+        journal_code = execute(lambda: Journal.search([
+                    ('type', '=', 'general'),
+                    ], limit=1)[0].code)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'moves.txt')
+            with open(path, 'wb') as f:
+                f.write(moves_data(start=331))
+            manifest = os.path.join(directory, 'manifest.csv')
+            with open(manifest, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['# file', 'company', 'journal'])
+                writer.writerow(['moves.txt', company_code, journal_code])
+
+            files = script.read_manifest(manifest)
+            self.assertEqual(files,
+                [(path, company_code, journal_code, '')])
+
+            result = script.import_file(DB_NAME, 2, *files[0])
+            self.assertEqual(result['state'], 'done', result['error'])
+            self.assertEqual(result['lines'], 15)
+            self.assertEqual(result['documents'], 5)
+
+            # the same file is not imported again
+            result = script.import_file(DB_NAME, 2, *files[0])
+            self.assertEqual(result['state'], 'failed')
+            self.assertTrue(result['error'])
+
 
 del ModuleTestCase